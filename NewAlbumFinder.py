@@ -12,16 +12,40 @@ that we don't have yet.  It does this by:
 
 DEBUG = False
 
-import urllib, json
-import os, sys, time, copy, re, string
-import optparse, glob, codecs
+import urllib2, httplib, json
+import os, sys, time, string
+import threading, Queue, multiprocessing, itertools
+import optparse, glob, codecs, unicodedata, collections
 import id3tags
+from responsecache import ResponseCache
+from scanindex import ScanIndex
+from histstore import HistoryStore, replaceFile
+from httpclient import KeepAliveClient
+from catalog import BACKENDS
+from ratelimit import TokenBucket, CircuitBreaker, backoffDelay, THROTTLE_CODES
+from perfstats import Stats, COUNT_BOUNDS
+from profiling import PhaseProfiler
+from htmlreport import HTMLReport, sortKey
+from exports import openExports, csvQuote, FORMATS as EXPORT_FORMATS
 
 appName = "NewAlbumFinder"
 appVersion = "1.0.0"
 
 # Initial default values, can override with command line options
 MINTRACKS = 8   # skip CDs with less than this number of tracks
+WORKERS = 4     # number of concurrent iTunes lookups
+SCAN_PROCESSES = 1  # number of processes reading ID3 tags
+HTTP_ENGINE = "urllib"  # "urllib" (new connection per search) or "keepalive"
+MAX_PER_HOST = 4    # maximum concurrent requests to the iTunes host with keepalive
+RATE = 10.0     # starting limit on iTunes requests per second
+RETRIES = 3     # times to retry a failed iTunes search
+TIMEOUT = 30    # seconds to wait for an iTunes response
+CHECKPOINT_EVERY = 50   # save search progress after this many artists
+CACHE_DAYS = 7  # re-fetch an artist's iTunes data once it's this old
+CACHE_MB = 50   # maximum size of the iTunes response cache
+PROFILER = "cprofile"   # "cprofile" or "sampling" (statprof, if installed) for --profile
+PROFILE_TOP = 30    # functions listed in the --profile summaries
+REPORT_PAGE_SIZE = 500  # albums per page of the HTML report
 musicPath = None
 
 # Use the wxPython GUI?
@@ -55,7 +79,7 @@ def print3(*args, **kwargs):
         f.write(item)
     f.write(end)
     
-def parseCmdLine():
+def parseCmdLine(argv = None):
     # Parse command line options
     if sys.platform == 'win32':
         outputDir = "Desktop"
@@ -80,20 +104,80 @@ def parseCmdLine():
         help="enable DEBUG mode")
     parser.add_option("-T", "--use_tree", action="store_true", dest="albums_from_dir_structure", default=False,
         help="get album list from directory tree")
-    (options, args) = parser.parse_args()
+    parser.add_option("--rescan", action="store_true", dest="rescan", default=False,
+        help="re-read the tags of every MP3 instead of using the scan index")
+    parser.add_option("--include", action="append", dest="include", default=[], metavar="GLOB",
+        help="only scan files matching GLOB (may be repeated) [default: *.mp3]")
+    parser.add_option("--exclude", action="append", dest="exclude", default=[], metavar="GLOB",
+        help="skip files and folders matching GLOB (may be repeated)")
+    parser.add_option("--follow-links", action="store_true", dest="followLinks", default=False,
+        help="follow symbolic links to folders when scanning for MP3s")
+    parser.add_option("-j", "--scan-processes", type="int", dest="scanProcesses", default=SCAN_PROCESSES,
+        help="number of processes reading ID3 tags in parallel [default: %default]")
+    parser.add_option("-w", "--workers", type="int", dest="workers", default=WORKERS,
+        help="number of concurrent iTunes lookups, 1 to search sequentially [default: %default]")
+    parser.add_option("--catalog", type="choice", choices=sorted(BACKENDS.keys()), dest="catalog",
+        default="itunes", help="catalog to search for albums [default: %default]")
+    parser.add_option("--catalog-url", type="string", dest="catalogURL", default=None, metavar="URL",
+        help="search the catalog at URL instead of its usual address, e.g. a local mockstore.py")
+    parser.add_option("--http", type="choice", choices=["urllib", "keepalive"], dest="http",
+        default=HTTP_ENGINE, help="how to fetch iTunes results: urllib opens a new connection "
+        "per artist, keepalive reuses persistent connections [default: %default]")
+    parser.add_option("--max-per-host", type="int", dest="maxPerHost", default=MAX_PER_HOST,
+        help="maximum concurrent requests to the iTunes host with --http=keepalive [default: %default]")
+    parser.add_option("--rate", type="float", dest="rate", default=RATE,
+        help="maximum iTunes requests per second, lowered automatically if iTunes "
+        "throttles us; 0 for no limit [default: %default]")
+    parser.add_option("--retries", type="int", dest="retries", default=RETRIES,
+        help="times to retry a failed iTunes search [default: %default]")
+    parser.add_option("--timeout", type="float", dest="timeout", default=TIMEOUT,
+        help="seconds to wait for each iTunes response [default: %default]")
+    parser.add_option("--resume", action="store_true", dest="resume", default=False,
+        help="resume an interrupted iTunes search, skipping artists it already searched")
+    parser.add_option("--cache-days", type="float", dest="cacheDays", default=CACHE_DAYS,
+        help="reuse cached iTunes results up to this many days old, 0 to disable the cache [default: %default]")
+    parser.add_option("--cache-mb", type="int", dest="cacheMB", default=CACHE_MB,
+        help="maximum size of the iTunes results cache in MB [default: %default]")
+    parser.add_option("-r", "--refresh", action="store_true", dest="refresh", default=False,
+        help="ignore cached iTunes results and search again for every artist")
+    parser.add_option("--offline", action="store_true", dest="offline", default=False,
+        help="only use cached iTunes results, don't go on the network")
+    parser.add_option("--page-size", type="int", dest="pageSize", default=REPORT_PAGE_SIZE,
+        help="albums per page of the HTML report [default: %default]")
+    parser.add_option("--export", type="choice", choices=list(EXPORT_FORMATS), action="append",
+        dest="exports", default=[], metavar="FORMAT",
+        help="also save the results in the output folder as FORMAT: jsonl, csv or sqlite (may be repeated)")
+    parser.add_option("--stats-json", type="string", dest="statsJSON", default=None,
+        help="save timings and counters for the scan and search to FILE as JSON", metavar="FILE")
+    parser.add_option("--profile", action="store_true", dest="profile", default=False,
+        help="profile the scan and search, saving .pstats files and summaries in the output folder")
+    parser.add_option("--profiler", type="choice", choices=["cprofile", "sampling"], dest="profiler",
+        default=PROFILER, help="profiler for --profile: cprofile or sampling [default: %default]")
+    parser.add_option("--profile-top", type="int", dest="profileTop", default=PROFILE_TOP,
+        help="functions to list in the profile summaries [default: %default]")
+    (options, args) = parser.parse_args(argv)
     return options, args
 
-def generateAlbumDataFromPath(path):
+def generateAlbumDataFromPath(path, stats = None):
     """
     Generate album database as a dictionary of unicode strings
         {artist1:[album1,album2,...], artist2:[album1,...]}
     from the toplevel path of your MP3 file tree.  Assumes that path
     contains a directory for each artist and each artist directory contains
-    a directory for each of their albums.
+    a directory for each of their albums.  Timings and counts go in stats
+    if given.
     """
-    artistCount = albumCount = 0
+    stats = stats or Stats()
+    with stats.timer("scan"):
+        albumDB = albumDataFromPath(path, stats)
+    albumDB.compact()
+    stats.count("scan.albums", sum([len(albumDB[artist]) for artist in albumDB.keys()]))
+    return albumDB
+
+def albumDataFromPath(path, stats):
+    "Does the work of generateAlbumDataFromPath, which times it"
     artistList = os.listdir(path)
-    albumDB = id3tags.ListDict()
+    albumDB = id3tags.AlbumDB()
     for artist in artistList:
         artistPath = os.path.join(path, artist)
         if not os.path.isdir(artistPath): continue
@@ -102,8 +186,10 @@ def generateAlbumDataFromPath(path):
         for f in artistFiles:
             subpath = os.path.join(artistPath, f)
             # If file is a directory containing MP3 files, assume it's an album
-            if os.path.isdir(subpath) and glob.glob(os.path.join(subpath, "*.mp3")):
-                addAlbum2DB(albumDB, artist, f)
+            if os.path.isdir(subpath):
+                stats.count("scan.dirs")
+                if glob.glob(os.path.join(subpath, "*.mp3")):
+                    addAlbum2DB(albumDB, artist, f)
     return albumDB
 
 def progressFun(n, msg):
@@ -122,50 +208,163 @@ def addAlbum2DB(db, artist, album):
             album = artist + ' greatest hits'   # this is how iTunes usually lists greatest hits albums
         db.add(artist, album)
     
-def generateAlbumDataFromMP3s(mp3s, progressFun = None):
+def readArtistAlbum(mp3, counts = None):
+    """Return (artist, album) from the ID3 tags of mp3, or (None, None) if it has no usable tag.
+    The kind of tag and bytes read are counted in counts if given (see id3tags.readTagRecord)."""
+    tag = id3tags.readTagRecord(mp3, id3tags.SCAN_FRAMES, counts=counts)
+    if tag and tag.artist is not None and tag.album is not None:
+        return tag.artist, tag.album
+    return None, None
+
+def openScanIndex(path):
+    "Open the scan index kept in the top-level MP3 folder path"
+    indexFileName = "%sIndex.db" % (appName)
+    return ScanIndex(os.path.join(path, indexFileName))
+
+def shardByDirectory(mp3s, index = None):
+    """
+    Group the list of MP3 paths into one shard per directory, as lists of
+    (path, indexed) tuples where indexed is the file's ScanIndex entry or None.
+    """
+    for dirname, paths in itertools.groupby(mp3s, os.path.dirname):
+        if index:
+            yield [(path, index.get(path)) for path in paths]
+        else:
+            yield [(path, None) for path in paths]
+
+def scanShard(shard):
+    """
+    Read the artist/album of the MP3s in one directory's shard (see
+    shardByDirectory).  As a shortcut, if the album name from the ID3 tag
+    matches the directory name, we assume the rest of the MP3s in that
+    directory are from the same artist/album and skip reading them.
+    Returns the number of files in the shard, a list of
+    (path, mtime, size, artist, album, parsed) tuples for the files looked at,
+    where parsed is False if the indexed artist/album were still valid, and a
+    dict of counts for the scan stats.
+    This runs in the scan worker processes, so it must not touch the index.
+    """
+    records = []
+    counts = {}
+    for path, indexed in shard:
+        if DEBUG: print path
+        st = os.stat(path)
+        if indexed and indexed[0] == st.st_mtime and indexed[1] == st.st_size:
+            artist, album = indexed[2:]
+            parsed = False
+        else:
+            artist, album = readArtistAlbum(path, counts)
+            parsed = True
+        records.append((path, st.st_mtime, st.st_size, artist, album, parsed))
+        if album is not None and album == os.path.basename(os.path.dirname(path)):
+            break   # skip the rest of this directory
+    return len(shard), records, counts
+
+def generateAlbumDataFromMP3s(mp3s, progressFun = None, index = None, processes = 1, stats = None):
     """
     Generate album database as a dictionary
         {artist1:[album1,album2,...], artist2:[album1,...]}
-    from the ID3 tags in the provided list of MP3 files.  As a shortcut,
-    if the album name from the ID3 tag matches the directory name, we assume
-    the rest of the MP3s in that directory are from the same artist/album and
-    skip reading them.
+    from the ID3 tags in the provided list (or iterator) of MP3 files.  Files are scanned a
+    directory at a time (see scanShard), on a pool of processes if processes
+    is more than 1; results are merged in the order of mp3s either way.
+    If a ScanIndex is given, only files that are new or changed since they
+    were indexed have their tags read, and files that no longer exist are
+    dropped from the index.  Timings and counts go in stats if given: the
+    time spent walking the directory tree (when mp3s is an iterator over the
+    walk), the number of files scanned, read and skipped, and which kind of
+    ID3 tag the artist and album came from.
     """
-    albumDB = id3tags.ListDict()
+    stats = stats or Stats()
+    with stats.timer("scan"):
+        albumDB = albumDataFromMP3s(mp3s, progressFun, index, processes, stats)
+    albumDB.compact()
+    stats.setRate("scan.filesPerSecond", "scan.files", "scan")
+    stats.setRate("scan.tagsReadPerSecond", "scan.tagsRead", "scan")
+    tagKinds = ("id3.v2", "id3.v1", "id3.v2+v1", "id3.none")
+    for kind in tagKinds:
+        stats.setRatio(kind + ".rate", kind, tagKinds)
+    return albumDB
+
+def timedIter(iterable, stats, name):
+    "Generate the items of iterable, timing how long each takes to produce as name"
+    iterator = iter(iterable)
+    while True:
+        with stats.timer(name):
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+        yield item
+
+def albumDataFromMP3s(mp3s, progressFun, index, processes, stats):
+    "Does the work of generateAlbumDataFromMP3s, which times it"
+    albumDB = id3tags.AlbumDB()
     i = 0
-    skipRestOfDirectory = False
-    lastDir = None
-    for mp3 in mp3s:
-        i += 1
+    seen = set()
+    try:
+        total = len(mp3s)
+    except TypeError:
+        total = None    # still walking the directory tree
+    if total is None:
+        mp3s = timedIter(mp3s, stats, "scan.walk")
+    shards = shardByDirectory(mp3s, index)
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(scanShard, shards, 4)
+    else:
+        results = itertools.imap(scanShard, shards)
+    for nfiles, records, counts in results:
+        stats.count("scan.files", nfiles)
+        stats.count("scan.skipped", nfiles - len(records))
+        stats.addCounts(counts)
+        tagsRead = len([record for record in records if record[5]])
+        stats.count("scan.tagsRead", tagsRead)
+        stats.count("scan.fromIndex", len(records) - tagsRead)
+        for path, mtime, size, artist, album, parsed in records:
+            if index:
+                seen.add(path)
+                if parsed: index.store(path, mtime, size, artist, album)
+            if album is not None:
+                addAlbum2DB(albumDB, artist, album)
+        i += nfiles
         if progressFun:
-            keep_going = progressFun(i, "MP3s scanned: %d of %d" % (i, len(mp3s)))
-            if not keep_going: return albumDB
-        thisDir = os.path.basename(os.path.dirname(mp3))
-        if skipRestOfDirectory:
-            if thisDir == lastDir:
-                continue    # skip this file
+            if total is None:
+                keep_going = progressFun(i, "MP3s scanned: %d" % i)
             else:
-                skipRestOfDirectory = False # we changed directories, so start need to read ID3 tag
-        lastDir = thisDir
-        if DEBUG: print mp3
-        # Try getting artist/album data from v2 tag first since it should be more accurate
-        v2tag = id3tags.ID3V2tag(mp3)
-        if v2tag.loaded and v2tag.artist != "N/A" and v2tag.album != "N/A":
-            album = v2tag.album
-            addAlbum2DB(albumDB, v2tag.artist, v2tag.album)
-        else:
-            # Try version 1 tag
-            v1tag = id3tags.ID3V1tag(mp3)
-            if v1tag.loaded and v1tag.artist != "N/A" and v1tag.album != "N/A":
-                album = v1tag.album
-                addAlbum2DB(albumDB, v1tag.artist, v1tag.album)
-        try:
-            if album == thisDir:
-                skipRestOfDirectory = True
-        except:
-            pass
+                keep_going = progressFun(i, "MP3s scanned: %d of %d" % (i, total))
+            if not keep_going:
+                if pool: pool.terminate()
+                if index: index.commit()
+                return albumDB
+    if pool: pool.close()
+    if index: index.prune(seen)
     return albumDB
 
+def memoize(maxsize):
+    "Decorator caching the results of a one argument function, keeping the maxsize most recently used"
+    def decorator(fun):
+        cache = collections.OrderedDict()
+        def memoized(arg):
+            try:
+                result = cache.pop(arg)
+            except KeyError:
+                result = fun(arg)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)   # drop least recently used
+            cache[arg] = result
+            return result
+        memoized.__name__ = fun.__name__
+        memoized.__doc__ = fun.__doc__
+        return memoized
+    return decorator
+
+# Punctuation stripped from album titles, as a translate table for unicode
+#  strings and a deletechars string for byte strings
+titlePunctuation = '?:;,.\'"'
+titlePunctuationTable = dict((ord(char), None) for char in titlePunctuation)
+
+@memoize(10000)
 def standardizeAlbumTitle(title):
     stdAlbum = title.replace(' & ',' and ').lower()
     # Strip off extra comments in title like "[Explicit version]"
@@ -178,12 +377,10 @@ def standardizeAlbumTitle(title):
     if stdAlbum[-4:] == ",the": # in case they left out the space
         stdAlbum = "the " + stdAlbum[:-4]
     # Strip out punctuation
-    punctuation = '?:;,.\'"'
-    s = stdAlbum
-    stdAlbum = ""
-    for char in s:
-        if char not in punctuation:
-            stdAlbum += char
+    if type(stdAlbum) == type(u' '):
+        stdAlbum = stdAlbum.translate(titlePunctuationTable)
+    else:
+        stdAlbum = stdAlbum.translate(None, titlePunctuation)
     stdAlbum = string.join(stdAlbum.split())    # reduce multiple spaces to one
     return stdAlbum
 
@@ -193,66 +390,55 @@ def printAlbumDB2CSV(albumDB, stream = sys.stdout):
     artistList.sort()
     for artist in artistList:
         for album in albumDB[artist]:
-            stream.write(u'"' + artist + u'","' + album + u'"\n')
+            stream.write(csvQuote(artist) + u',' + csvQuote(album) + u'\n')
  
 def capwords(astring):
     words = astring.split()
     capwordlist = [ word.capitalize() for word in words ]
     return u' '.join(capwordlist)
  
-def newCDdb2html(newCDdb, filepath):
-    "Write the list of new CDs to an HTML file"
-    writer = codecs.getwriter('utf-8')
-    of = writer(open(filepath, "w"))
-    of.write("""<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8" /><style> body {font-family: sans-serif} </style>
-    <title>CDs You Don't Have</title></head><body><h1>CDs You Don't Have</h1>\n""")
+def newCDdb2html(newCDdb, filepath, pageSize = REPORT_PAGE_SIZE):
+    """Write the list of new CDs to an HTML index page at filepath and
+    pages of about pageSize albums next to it (see htmlreport.HTMLReport)"""
+    report = HTMLReport(filepath, u"CDs You Don't Have", pageSize)
     artistList = list(newCDdb.keys())
-    artistList.sort()
+    artistList.sort(key=sortKey)
     for artist in artistList:
-        of.write("<h3>%s</h3><table border='1'><tr><th></th><th>Album</th><th>Year</th><th>Genre</th><th>Tracks</th></tr>" % capwords(artist))
-        for albumInfo in newCDdb[artist]:
-            [year, title, genre, tracks, image, albumLink] = albumInfo
-            # Add album to table
-            try:
-                of.write("<tr><td><a href='%s' target='_new'><img src='%s'/></a></td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n"
-                  % (albumLink, image, title, year, genre, tracks))
-            except UnicodeEncodeError:
-                pass
-        of.write("</table>\n")
-    of.write("</body></html>\n")
-    of.close()
+        report.addArtist(capwords(artist), newCDdb[artist])
+    report.close()
 
 def artistNamesMatch(artist1, artist2):
     """Return true if artist names are essentially the same by ignoring case
-    stripping off any leading 'The' (so 'Beatles' and 'The Beatles' match)"""
-    match = False
-    if DEBUG: print "Comparing %s <-> %s" % (artist1, artist2)
-    a1 = artist1.lower()
-    a2 = artist2.lower()
-    if a1.find("the ") == 0: a1 = a1[4:]
-    if a2.find("the ") == 0: a2 = a2[4:]
-    a1 = a1.replace(' & ',' and ')
-    a2 = a2.replace(' & ',' and ')
-    if a1 == a2:
-        match = True    # already match
-    else:
-        # No match but could be because one name has accented chars and the other doesn't
-        try:
-            # See if there are any non-ascii characters
-            a1ascii = a1.encode('ascii')
-            a2ascii = a2.encode('ascii')
-            if DEBUG: print "No funny characters"
-        except UnicodeEncodeError:
-            if DEBUG: print "Unicode decode error!"
-            # Funny character in one or both strings, replace them with periods
-            a1regexp = a1.encode('ascii','replace').replace('?','.')
-            a2regexp = a2.encode('ascii','replace').replace('?','.')
-            # Now see if they match as regular expressions
-            if DEBUG: print "doing re.match on %s <-> %s" % (a1regexp, a2regexp)
-            match = re.match(a1regexp, a2regexp) is not None or re.match(a2regexp, a1regexp) is not None
-    if DEBUG: print "match =", match
+    and accents and stripping off any leading 'The' (so 'Beatles' and 'The Beatles' match)"""
+    match = normalizeArtistName(artist1) == normalizeArtistName(artist2)
+    if DEBUG: print "Comparing %s <-> %s: match = %s" % (artist1, artist2, match)
     return match
 
+def normalizeArtistName(artist):
+    """Standardize artist name (see standardizeArtistName), then remove accents
+    and extra spaces, so 'The Beatles' matches 'beatles' and accented names
+    match their plain ASCII spelling"""
+    a = standardizeArtistName(artist)
+    if type(a) != type(u' '):
+        a = unicode(a, 'latin-1')
+    # Split accented chars into base char + combining accent, then drop the accents
+    a = u''.join([c for c in unicodedata.normalize('NFKD', a) if not unicodedata.combining(c)])
+    return u' '.join(a.split())
+
+class ArtistNameIndex:
+    """Normalized artist names, each computed only once, so matching the
+    artist names in iTunes results to the artist we searched for is a dict
+    lookup and a string compare"""
+    def __init__(self):
+        self.normalized = {}
+
+    def __getitem__(self, artist):
+        try:
+            return self.normalized[artist]
+        except KeyError:
+            key = self.normalized[artist] = normalizeArtistName(artist)
+            return key
+
 def standardizeArtistName(artist):
     """Prevent duplicate artist entries by ignoring case and
     stripping off any leading 'The' (so 'Beatles' and 'The Beatles' match)"""
@@ -266,87 +452,548 @@ def standardizeArtistName(artist):
     return a
 
 def loadHistFile(path):
-    """Load the iTunes data from our last run"""
-    histData = {}
-    if not os.path.exists(path):
-        return histData
-    f = codecs.open(path, 'r', 'utf8')
-    while 1:
-        line = f.readline()
-        if not line: break
-        line = line.strip()
-        artist, album = line.split(u'\t')
-        if artist in histData.keys():
-            histData[artist].append(album)
-        else:
-            histData[artist] = [album]
-    f.close()
-    return histData
+    """Load the iTunes data from our previous runs"""
+    return HistoryStore(path)
 
-def saveHistFile(data, path):
-    """Save all albums found in iTunes (for our artists)"""
-    f = codecs.open(path, 'w', 'utf8')
+def saveHistFile(data, history):
+    """Save all albums found in iTunes (for our artists) to the HistoryStore"""
     artists = list(data.keys())
     artists.sort()
     for artist in artists:
-        albums = data[artist]
-        for album in albums:
-            f.write(artist + u"\t" + album + u"\n")
-    f.close()
+        history.update(artist, data[artist])
+    history.commit()
     
+def findOutputDir(outdir):
+    "Return the folder to put the output files in for the --outdir option value outdir"
+    if outdir == "Desktop" and sys.platform == "win32":
+        return os.path.join(os.environ["USERPROFILE"], "Desktop")
+    # This should work with most Linux/Unix versions
+    outputDir = os.path.join(os.environ["HOME"], "Desktop")
+    if not os.path.isdir(outputDir):
+        outputDir = os.environ["HOME"]
+    return outputDir
+
 def progressDisplay(i, msg):
     print i, msg
     return True
+
+class Lookup:
+    "One pending iTunes lookup, filled in by a worker thread"
+    def __init__(self, artist):
+        self.artist = artist
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+def lookupWorker(tasks, fetch, cancel, finished):
+    "Thread body: run fetch on queued Lookups until we get a None"
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        if not cancel.is_set() and not finished.is_set():
+            try:
+                task.result = fetch(task.artist)
+            except Exception, e:
+                task.error = e
+        task.done.set()
+
+def fetchInOrder(artists, fetch, workers, cancel, profiler = None, progress = None):
+    """
+    Generator yielding (artist, fetch(artist)) for each artist in order.
+    Up to workers lookups run concurrently on a pool of threads, but never
+    more than 2*workers artists ahead of the consumer.  Setting the cancel
+    event (from any thread) stops the pool from starting any more lookups
+    and ends the generator even while it's waiting for one; fetch should
+    watch the same event so lookups in flight give up too, and their
+    results are thrown away.  If given, progress(artist) is called before
+    each artist is fetched (or, with a pool, before waiting for its
+    lookup); if it returns False, cancel is set.  If a PhaseProfiler is
+    given, the threads are profiled too and waited for at the end so their
+    profiles are complete.
+    """
+    if workers <= 1:
+        for artist in artists:
+            if progress and not progress(artist):
+                cancel.set()
+            if cancel.is_set(): return
+            yield artist, fetch(artist)
+        return
+    finished = threading.Event()    # tells the pool we're done with it
+    tasks = Queue.Queue()
+    threads = []
+    target = lookupWorker
+    if profiler:
+        target = profiler.threadTarget(lookupWorker)
+    for n in range(workers):
+        t = threading.Thread(target=target, args=(tasks, fetch, cancel, finished))
+        t.daemon = True     # don't let a stuck urlopen keep us from exiting
+        t.start()
+        threads.append(t)
+    pending = []
+    artists = iter(artists)
+    try:
+        while True:
+            # Keep the queue topped up with a bounded number of lookups
+            while len(pending) < 2 * workers:
+                try:
+                    task = Lookup(artists.next())
+                except StopIteration:
+                    break
+                pending.append(task)
+                tasks.put(task)
+            if not pending or cancel.is_set():
+                break
+            task = pending.pop(0)
+            if progress and not progress(task.artist):
+                cancel.set()
+                break
+            # Wait with a timeout so Ctrl-C and cancel still work
+            while not task.done.wait(0.1) and not cancel.is_set():
+                pass
+            if cancel.is_set():
+                break
+            if task.error is not None:
+                raise task.error
+            yield task.artist, task.result
+    finally:
+        finished.set()
+        for t in threads:
+            tasks.put(None)
+        if profiler:
+            for t in threads:
+                t.join()
      
     
+class NotFoundTracker:
+    """
+    The albums we have that weren't found in iTunes, for each artist in
+    albumDB.  Rather than a copy of albumDB, all it keeps is a bitmask per
+    artist of which of their albums (by position in albumDB's list) were
+    found; tracker[artist] builds the list of the rest when it's wanted.
+    Reads like an AlbumDB, so it can be passed to printAlbumDB2CSV.
+    """
+    def __init__(self, albumDB):
+        self.albumDB = albumDB
+        self.found = {}     # {artist: bitmask of found albums}, only for artists with any
+
+    def __getitem__(self, artist):
+        found = self.found.get(artist, 0)
+        albums = self.albumDB[artist]
+        if not found:
+            return list(albums)
+        return [album for i, album in enumerate(albums) if not found >> i & 1]
+
+    def __contains__(self, artist):
+        return artist in self.albumDB
+
+    def keys(self):
+        return self.albumDB.keys()
+
+    def markFound(self, artist, titles):
+        "Record that artist's albums in the set titles were found"
+        found = self.found.get(artist, 0)
+        for i, album in enumerate(self.albumDB[artist]):
+            if album in titles:
+                found |= 1 << i
+        if found:
+            self.found[artist] = found
+
+    def setNotFound(self, artist, notFound):
+        "Record that of artist's albums, only those in the list notFound weren't found"
+        notFound = set(notFound)
+        self.found.pop(artist, None)
+        self.markFound(artist, set([album for album in self.albumDB[artist] if album not in notFound]))
+
+class SearchResults:
+    """What runSearch has found so far: the new CDs and all the albums found
+    in iTunes for each artist, and the albums we have that weren't found"""
+    def __init__(self, albumDB):
+        self.newCDdb = {}     # CDs I don't have yet from artists I like
+        self.iTunesResults = {}
+        self.uniqueAlbums = set()     # unique artist/album names to avoid duplicates found in iTunes
+        self.newCDcount = 0
+        # which albums we have weren't in the database
+        self.CDsNotFound = NotFoundTracker(albumDB)
+        self.failed = []    # artists we couldn't search iTunes for
+        self.done = set()   # artists we've searched
+
+    def saveCheckpoint(self, path):
+        "Save the results so far to path, replacing it only once the new checkpoint is complete"
+        state = {'done': sorted(self.done), 'newCDdb': self.newCDdb,
+            'iTunesResults': self.iTunesResults, 'uniqueAlbums': sorted(self.uniqueAlbums),
+            'newCDcount': self.newCDcount,
+            'CDsNotFound': dict([(artist, self.CDsNotFound[artist]) for artist in self.done])}
+        tmpPath = path + ".tmp"
+        f = open(tmpPath, 'w')
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        replaceFile(tmpPath, path)
+
+    def loadCheckpoint(self, path):
+        "Restore the results saved by saveCheckpoint, if there are any"
+        if not os.path.exists(path):
+            return
+        f = open(path)
+        state = json.load(f)
+        f.close()
+        self.newCDdb = state['newCDdb']
+        self.iTunesResults = state['iTunesResults']
+        self.uniqueAlbums = set(state['uniqueAlbums'])
+        self.newCDcount = state['newCDcount']
+        for artist, notFound in state['CDsNotFound'].items():
+            if artist in self.CDsNotFound:
+                self.CDsNotFound.setNotFound(artist, notFound)
+        # Drop the results for artists no longer in the library, e.g. if
+        #  their files were removed since the checkpoint was saved
+        self.done = set()
+        for artist in state['done']:
+            if artist in self.CDsNotFound:
+                self.done.add(artist)
+            else:
+                self.newCDcount -= len(self.newCDdb.pop(artist, []))
+                self.iTunesResults.pop(artist, None)
+
+    def addArtist(self, artist, newCDlist, allAlbums, foundAlbums, uniqueAlbums):
+        """
+        Add what the search found for artist and mark it done.  The search
+        collects an artist's results on its own and only adds them here once
+        it's finished with them, so a checkpoint never holds part of an
+        artist's results.
+        """
+        self.uniqueAlbums.update(uniqueAlbums)
+        self.newCDcount += len(newCDlist)
+        if foundAlbums:
+            self.CDsNotFound.markFound(artist, foundAlbums)
+        if newCDlist:
+            self.newCDdb[artist] = newCDlist
+        if allAlbums:
+            self.iTunesResults[artist] = allAlbums
+        self.done.add(artist)
+
 class AlbumFinder:
     
-    def __init__(self, options, progressFun = progressDisplay):
+    def __init__(self, options, progressFun = progressDisplay, artistDoneFun = None):
 
         self.MINTRACKS = options.MINTRACKS
         self.outputDir = options.outdir
         self.musicPath = options.tunesDir
         self.writeLogfile = DEBUG or options.writeLogfile
         self.minYear = options.minYear
+        self.pageSize = options.pageSize
+        self.exportFormats = sorted(set(options.exports))
+        self.exports = []
         self.ignorePreviousRun = options.ignorePrevious
+        self.resume = options.resume
+        self.workers = max(1, options.workers)
+        self.refresh = options.refresh
+        self.retries = options.retries
+        self.timeout = options.timeout
+        self.limiter = None
+        if options.rate > 0:
+            self.limiter = TokenBucket(options.rate)
+        # Stops us retrying every artist if iTunes is down
+        self.breaker = CircuitBreaker()
+        self.http = None
+        if options.http == "keepalive":
+            self.http = KeepAliveClient(options.maxPerHost, options.timeout)
+        self.offline = options.offline
         self.progressFun = progressFun
+        # Called with each artist and the list of new CDs found for them as
+        #  the search gets through the artists
+        self.artistDoneFun = artistDoneFun
+        # Set from another thread (e.g. the GUI's) to stop the search as soon as possible
+        self.cancel = threading.Event()
+        # Timings and counters for the search; pass it to the scan functions too to get theirs
+        self.stats = Stats()
 
-        if self.outputDir == "Desktop" and sys.platform == "win32":
-            self.outputDir = os.path.join(os.environ["USERPROFILE"], "Desktop")
-        else:
-            # This should work with most Linux/Unix versions
-            self.outputDir = os.path.join(os.environ["HOME"], "Desktop")
-            if not os.path.isdir(self.outputDir):
-                self.outputDir = os.environ["HOME"]
+        self.outputDir = findOutputDir(self.outputDir)
        
         if not self.outputDir or not os.path.isdir(self.outputDir):
             err_exit(str(self.outputDir) + " is not a valid output file path.")
+        # Profiles of the scan and search go in the output folder too
+        self.profiler = None
+        if options.profile:
+            self.profiler = PhaseProfiler(self.outputDir, appName, options.profileTop,
+                options.profiler == "sampling")
         if not self.musicPath:
             self.musicPath = raw_input("Please enter the top-level path to your MP3 files: ")
         if not os.path.isdir(self.musicPath):
             err_exit("Error: " + str(self.musicPath) + " is not a valid folder path for finding your MP3 files.")
             
-        # Base URL for searching iTunes Store web service to find all albums by a given artist
-        self.iTunesURL = "http://ax.phobos.apple.com.edgesuite.net/WebObjects/MZStoreServices.woa/wa/wsSearch?"
-        self.iTunesURL += "{artistTerm}&media=music&entity=album&attribute=artistTerm"
+        # The catalog we search for all albums by a given artist
+        self.catalog = BACKENDS[options.catalog](options.catalogURL)
 
 
         outFileName = "CDs You Don't Have.html"
         self.outFilePath = os.path.join(self.outputDir, outFileName)
+        self.exportBase = os.path.join(self.outputDir, appName + "-results")
         histFileName = "%s.dat" % (appName)
         self.histFilePath = os.path.join(self.musicPath, histFileName)
+        checkpointFileName = "%s.checkpoint" % (appName)
+        self.checkpointPath = os.path.join(self.musicPath, checkpointFileName)
+        # Cache of iTunes responses so repeat runs only search for stale artists
+        self.cache = None
+        if options.cacheDays > 0:
+            cacheFileName = "%sCache.db" % (appName)
+            self.cache = ResponseCache(os.path.join(self.musicPath, cacheFileName),
+                ttl=options.cacheDays*24*3600, maxBytes=options.cacheMB*1024*1024)
+
+    def httpGet(self, url, parse):
+        "Return what parse makes of the response to a GET of url, read as it arrives"
+        if self.http:
+            return self.http.get(url, parse)
+        f = urllib2.urlopen(url, timeout=self.timeout)
+        try:
+            return parse(f)
+        finally:
+            f.close()
+
+    def fetchArtist(self, artist):
+        """
+        Return (url, albums) for a catalog search on artist, or None if it
+        still failed after all our retries or the circuit breaker has given
+        up on iTunes.  Requests are paced by the rate limiter and failed
+        ones retried with exponential backoff.  Only the
+        album dicts are cached, not the whole response.
+        Runs on a worker thread.
+        """
+        stats = self.stats
+        url = self.catalog.searchURL(artist)
+        if self.cache and not self.refresh:
+            cached = self.cache.get(url, allowStale=self.offline)
+            if cached is not None:
+                stats.count("cache.hits")
+                return url, json.loads(cached)
+            stats.count("cache.misses")
+        if self.offline:
+            return url, []
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                stats.count("http.circuitOpen")
+                break
+            if attempt:
+                stats.count("http.retries")
+                self.cancel.wait(backoffDelay(attempt))
+            if self.cancel.is_set():
+                return None
+            if self.limiter:
+                with stats.timer("http.rateLimitWait"):
+                    if not self.limiter.acquire(self.cancel):
+                        return None
+            start = time.time()
+            try:
+                albums = self.httpGet(url, self.catalog.parseStream)
+            except (IOError, ValueError, KeyError, httplib.HTTPException), e:
+                if DEBUG: print "iTunes search for %s failed: %s" % (artist, e)
+                stats.count("http.errors")
+                self.breaker.record(False)
+                if getattr(e, 'code', None) in THROTTLE_CODES:
+                    stats.count("http.throttled")
+                    if self.limiter:
+                        self.limiter.throttled()
+                continue
+            stats.count("http.requests")
+            self.breaker.record(True)
+            stats.observe("http.latencyMs", (time.time() - start) * 1000)
+            if self.limiter:
+                self.limiter.succeeded()
+            if self.cache:
+                self.cache.put(url, json.dumps(albums, separators=(',', ':')))
+            return url, albums
+        stats.count("http.gaveUp")
+        return None
+
+    def searchArtist(self, artist, fetched, albumDB, results):
+        "Add what the iTunes search fetched for artist to results, marking artist done"
+        logFstream = self.logFstream
+        url, albumList = fetched
+        newCDlist = []
+        filtered = collections.Counter()    # why albums weren't new, for the stats
+        if self.writeLogfile: 
+            logFstream.write("\nSearch iTunes for: " + artist + "\n")
+        if self.writeLogfile: logFstream.write(url)
+        if self.writeLogfile: logFstream.write(json.dumps(albumList, ensure_ascii=False))
+        self.stats.count("search.artists")
+        self.stats.observe("match.resultsPerArtist", len(albumList), COUNT_BOUNDS)
+        if not albumList:
+            results.addArtist(artist, [], [], None, ())
+            return
+        if self.writeLogfile: logFstream.write("Have albums: " + repr(albumDB[artist]) + u"\n")
+        allAlbums = []      # save all albums found in iTunes for this artist
+        wantedArtist = self.artistIndex[artist]
+        haveAlbums = set(map(standardizeAlbumTitle, albumDB[artist]))
+        foundAlbums = set()     # albums we have that are in iTunes
+        newKeys = set()     # artist/album names of the new CDs, see results.uniqueAlbums
+        for album in albumList:
+            name = album['artist']
+            # Itunes will return artists with names similar to the one we asked for.
+            # Eliminate any that aren't exact matches.
+            if self.artistIndex[name] != wantedArtist:
+                try:
+                    if self.writeLogfile: logFstream.write("want artist " + artist + " skipping " + name + '\n')
+                except UnicodeDecodeError:
+                    if self.writeLogfile: logFstream.write("want artist " + repr(artist) + " skipping " + repr(name) + '\n')
+                filtered["match.otherArtist"] += 1
+                continue
+            title = album['title']
+            if title[-8:] == '- Single': 
+                if DEBUG: print 'Skipping single'
+                filtered["match.single"] += 1
+                continue
+            allAlbums.append(title)
+            stdTitle = standardizeAlbumTitle(title)
+            if DEBUG: print "  Checking album: ", stdTitle
+            genre = album['genre']
+            tracks = album['tracks']
+            # Provide a way to skip singles and EPs
+            if tracks < MINTRACKS:
+                if DEBUG: print "  Skipping ", stdTitle, " too few tracks"
+                filtered["match.tooFewTracks"] += 1
+                continue
+            if album['releaseDate']:
+                year = int(album['releaseDate'][0:4])
+            else:
+                year = 0
+            image = album['image']
+            albumLink = album['link']
+            if year < self.minYear:
+                if DEBUG: print "  Skipping ", stdTitle, " too few tracks"
+                filtered["match.tooOld"] += 1
+                continue
+            if stdTitle in haveAlbums:
+                if self.writeLogfile: logFstream.write("   have -> " + title + "\n")
+                foundAlbums.add(stdTitle)
+                filtered["match.have"] += 1
+                continue
+            if not self.ignorePreviousRun and self.history.seen(artist, title):
+                if self.writeLogfile: logFstream.write("   previously saw -> " + title + "\n")
+                filtered["match.previouslySeen"] += 1
+                continue
+            
+            # Is it a duplicate?
+            key = name.lower() + "," + stdTitle
+            if key in results.uniqueAlbums or key in newKeys:
+                filtered["match.duplicate"] += 1
+                continue
+            newKeys.add(key)
+            
+            if DEBUG: print "New album: ", stdTitle, title, haveAlbums
+            newCDlist.append([year, title, genre, tracks, image, albumLink])
+
+        self.stats.addCounts(filtered)
+        self.stats.count("match.results", len(albumList))
+        self.stats.count("match.new", len(newCDlist))
+        self.stats.observe("match.newPerArtist", len(newCDlist), COUNT_BOUNDS)
+
+        # Sort new CD list by release year (first field)
+        newCDlist.sort(reverse=True)
+        results.addArtist(artist, newCDlist, allAlbums, foundAlbums, newKeys)
         
+    def searchArtists(self, albumDB, results):
+        """
+        Search iTunes for each artist in albumDB that isn't done yet, adding
+        what we find to results and checkpointing them every CHECKPOINT_EVERY
+        artists.  Returns False if the user aborted the search.
+        """
+        artistList = list(albumDB.keys())
+        artistList.sort()
+        artistNum = len(artistList)
+        aCount = len(results.done)
+        artistList = [artist for artist in artistList if artist not in results.done]
+        retryQueue = []     # artists whose searches failed
+        counts = [aCount]
+
+        def progress(artist):
+            "Report the artist about to be searched; False if the user aborted the search"
+            counts[0] += 1
+            return self.progressFun(counts[0], string.capwords(artist))
+
+        # Lookups run ahead on worker threads; results come back in artistList
+        #  order.  Aborting sets self.cancel, which fetchArtist watches too, so
+        #  lookups in flight give up rather than retrying.
+        for artist, fetched in fetchInOrder(artistList, self.fetchArtist, self.workers, self.cancel,
+                self.profiler, progress):
+            aCount = counts[0]
+            if fetched is None:
+                retryQueue.append(artist)
+                continue
+            self.searchArtist(artist, fetched, albumDB, results)
+            self.artistDone(artist, results)
+            if len(results.done) % CHECKPOINT_EVERY == 0:
+                results.saveCheckpoint(self.checkpointPath)
+            
+            if DEBUG and aCount > 30:
+                print "DEBUG mode is enabled.  Stopping after first 30 artists."
+                break
+
+        if self.cancel.is_set():
+            return False
+
+        # Give the searches that failed one more go, one at a time now that
+        #  the rest of the run is out of the way, unless nearly every search
+        #  is failing
+        if retryQueue and self.breaker.isOpen():
+            print "iTunes searches are failing, not retrying the %d that failed" % len(retryQueue)
+            results.failed.extend(retryQueue)
+            retryQueue = []
+        if retryQueue:
+            print "Retrying iTunes search for %d artists" % len(retryQueue)
+
+        def retryProgress(artist):
+            return self.progressFun(artistNum, "Retrying " + string.capwords(artist))
+
+        for artist, fetched in fetchInOrder(retryQueue, self.fetchArtist, 1, self.cancel,
+                progress=retryProgress):
+            if fetched is None:
+                results.failed.append(artist)
+            else:
+                self.searchArtist(artist, fetched, albumDB, results)
+                self.artistDone(artist, results)
+        return not self.cancel.is_set()
+
+    def artistDone(self, artist, results):
+        """Pass the new CDs found for artist to artistDoneFun, if there is one,
+        and write artist's results to the exports"""
+        if self.artistDoneFun:
+            self.artistDoneFun(artist, results.newCDdb.get(artist, []))
+        if self.exports:
+            with self.stats.timer("export"):
+                for export in self.exports:
+                    export.addArtist(artist, results.newCDdb.get(artist, []),
+                        results.iTunesResults.get(artist, []), results.CDsNotFound[artist])
+
+    def profile(self, phase, fun, *args, **kwargs):
+        "Return fun(*args, **kwargs), profiled as phase if we're profiling"
+        if self.profiler:
+            return self.profiler.run(phase, fun, *args, **kwargs)
+        return fun(*args, **kwargs)
+
     def runSearch(self, albumDB):
-        if self.ignorePreviousRun:
-            histData = {}
-        else:
-            histData = loadHistFile(self.histFilePath)
+        "Search iTunes for the albums by the artists in albumDB and report the ones we don't have"
+        try:
+            return self.profile("search", self.search, albumDB)
+        finally:
+            # Even if the search was stopped, trim the cache and close our connections
+            if self.cache:
+                self.cache.evict()
+            if self.http:
+                self.stats.count("http.connections", self.http.connections)
+                self.http.close()
+
+    def search(self, albumDB):
+        # Load the albums found on previous runs even if we're ignoring them
+        #  so we only have to add the new ones when we save
+        self.history = loadHistFile(self.histFilePath)
 
         if self.writeLogfile:
             logFname = appName + ".log"
             logFstream = codecs.open(os.path.join(self.outputDir, logFname), "w", encoding='utf8')
         else:
             logFstream = sys.stdout
+        self.logFstream = logFstream
             
         if DEBUG:
             print "mintracks=", self.MINTRACKS, "outdir=", self.outputDir
@@ -354,149 +1001,91 @@ class AlbumFinder:
             print "Dumped your album list to " + logFname
             #sys.exit()
 
-        # use a copy to track which albums we have that weren't in the database
-        CDsNotFound = copy.deepcopy(albumDB)
-
-        newCDcount = 0
-
-        newCDdb = {}     # CDs I don't have yet from artists I like
-        uniqueAlbums = {}     # unique artist/album names to avoid duplicates found in iTunes
-
-        artistList = list(albumDB.keys())
-        artistList.sort()
-        artistNum = len(artistList)
-        aCount = 0
-        iTunesResults = {}
+        results = SearchResults(albumDB)
+        # Results are exported as each artist is done, resumed ones included
+        self.exports = openExports(self.exportFormats, self.exportBase)
+        if self.resume:
+            results.loadCheckpoint(self.checkpointPath)
+            if results.done:
+                print "Resuming search, %d artists already done" % len(results.done)
+                for artist in sorted(results.done):
+                    self.artistDone(artist, results)
+        self.artistIndex = ArtistNameIndex()
         
         startTime = time.ctime()
 
-        for artist in artistList:
-            aCount += 1
-            namePrinted = False
-            newCDlist = []
-            if not self.progressFun(aCount, string.capwords(artist)):
-                return  # user aborted the search
-            if self.writeLogfile: 
-                logFstream.write("\nSearch iTunes for: " + artist + "\n")
-            try:
-                artistTerm = urllib.urlencode({"term":artist})
-            except:
-                a = artist.encode('utf8','replace')
-                artistTerm = urllib.urlencode({"term":a})
-            url = self.iTunesURL.replace("{artistTerm}", artistTerm)
-            if self.writeLogfile: logFstream.write(url)
-            f = urllib.urlopen(url)
-            json_string = f.read().decode("utf-8")
-            f.close()
-            if self.writeLogfile: logFstream.write(json_string)
-            data = json.loads(json_string)
-            if DEBUG: print "found %d results" % data['resultCount']
-            if data['resultCount'] == 0: continue
-            if self.writeLogfile: logFstream.write("Have albums: " + repr(albumDB[artist]) + u"\n")
-            albumList = data['results']
-            allAlbums = []      # save all albums found in iTunes for this artist
-            for album in albumList:
-                name = album['artistName']
-                # Itunes will return artists with names similar to the one we asked for.
-                # Eliminate any that aren't exact matches.
-                if not artistNamesMatch(name, artist):
-                    try:
-                        if self.writeLogfile: logFstream.write("want artist " + artist + " skipping " + name + '\n')
-                    except UnicodeDecodeError:
-                        if self.writeLogfile: logFstream.write("want artist " + repr(artist) + " skipping " + repr(name) + '\n')
-                    continue
-                title = album['collectionName']
-                if title[-8:] == '- Single': 
-                    if DEBUG: print 'Skipping single'
-                    continue
-                allAlbums.append(title)
-                stdTitle = standardizeAlbumTitle(title)
-                if DEBUG: print "  Checking album: ", stdTitle
-                genre = album['primaryGenreName']
-                tracks = album['trackCount']
-                # Provide a way to skip singles and EPs
-                if tracks < MINTRACKS:
-                    if DEBUG: print "  Skipping ", stdTitle, " too few tracks"
-                    continue
-                if album['releaseDate']:
-                    year = int(album['releaseDate'][0:4])
-                else:
-                    year = 0
-                if copyright in album.keys():
-                    match = re.search('\d\d\d\d ', album['copyright'])       # find 1st 4 digit string
-                    if match: 
-                        year2 = int(match.group(0))
-                        # Often releaseDate reflects a re-release date and copyright is original date
-                        if year > 0: year = min(year, year2)
-                image = album['artworkUrl100']
-                albumLink = album['collectionViewUrl']
-                if year < self.minYear:
-                    if DEBUG: print "  Skipping ", stdTitle, " too few tracks"
-                    continue
-                haveAlbums = map(standardizeAlbumTitle, albumDB[artist])
-                if stdTitle in haveAlbums:
-                    if self.writeLogfile: logFstream.write("   have -> " + title + "\n")
-                    try:
-                        CDsNotFound[artist].remove(stdTitle)
-                    except:
-                        # might have already deleted this album
-                        pass
-                    continue
-                if artist in histData.keys() and title in histData[artist]:
-                    if self.writeLogfile: logFstream.write("   previously saw -> " + title + "\n")
-                    continue
-                
-                # Is it a duplicate?
-                key = name.lower() + "," + stdTitle
-                if key in uniqueAlbums.keys(): continue
-                uniqueAlbums[key] = 1
-                
-                if DEBUG: print "New album: ", stdTitle, title, haveAlbums
-                newCDcount += 1
-                newCDlist.append([year, title, genre, tracks, image, albumLink])
-            
-            if len(newCDlist) > 0:                
-                # Sort new CD list by release year (first field)
-                newCDlist.sort(reverse=True)
-            
-                # Save list of new CDs for current artist
-                newCDdb[artist] = newCDlist
-                
-            if len(allAlbums) > 0:
-                iTunesResults[artist] = allAlbums
-            
-            if DEBUG and aCount > 30:
-                print "DEBUG mode is enabled.  Stopping after first 30 artists."
-                break
+        stats = self.stats
+        completed = False
+        try:
+            with stats.timer("search"):
+                completed = self.searchArtists(albumDB, results)
+        except (KeyboardInterrupt, Exception):
+            # Keep what we've got so far for --resume
+            results.saveCheckpoint(self.checkpointPath)
+            raise
+        finally:
+            # A stopped search's exports would be incomplete, so keep the last run's
+            if not completed:
+                for export in self.exports:
+                    export.discard()
+                self.exports = []
+        if not completed:
+            results.saveCheckpoint(self.checkpointPath)
+            return  # user aborted the search
+        if results.failed:
+            print "Couldn't search iTunes for %d artists:" % len(results.failed), u", ".join(results.failed)
+        stats.count("search.failed", len(results.failed))
+        for export in self.exports:
+            for artist in results.failed:
+                export.addFailed(artist)
+            export.close()
+            print "Exported results to", ", ".join(export.paths)
+        self.exports = []
+        stats.setRate("search.artistsPerSecond", "search.artists", "search")
+        stats.setRatio("cache.hitRatio", "cache.hits", ("cache.hits", "cache.misses"))
 
         # Output list of CDs we don't have
-        if newCDcount:
+        if results.newCDcount:
             print "Generating HTML file: ", self.outFilePath
-            newCDdb2html(newCDdb, self.outFilePath)
-        print "Found %d CDs you don't have." % (newCDcount)
+            with stats.timer("report"):
+                newCDdb2html(results.newCDdb, self.outFilePath, self.pageSize)
+        print "Found %d CDs you don't have." % (results.newCDcount)
 
         # Save current iTunes data
         print "Saving iTunes data in", self.histFilePath
-        saveHistFile(iTunesResults, self.histFilePath)
+        with stats.timer("history"):
+            saveHistFile(results.iTunesResults, self.history)
+        # The history now has everything, so the search is complete
+        if os.path.exists(self.checkpointPath):
+            os.remove(self.checkpointPath)
             
         if self.writeLogfile:
             logFstream.write("The following albums were not found in iTunes:")
-            printAlbumDB2CSV(CDsNotFound, logFstream)
+            printAlbumDB2CSV(results.CDsNotFound, logFstream)
         print "Started at %s, finished at %s" % (startTime, time.ctime())
-        return newCDcount
+        return results.newCDcount
             
             
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     options, args = parseCmdLine()
     DEBUG = options.debug
     if not USE_WX or options.nogui:
         af = AlbumFinder(options)
         if (options.albums_from_dir_structure):
-            albumDB = generateAlbumDataFromPath(options.tunesDir)
+            albumDB = af.profile("scan", generateAlbumDataFromPath, af.musicPath, af.stats)
         else:
-            mp3s = id3tags.findMP3s(options.tunesDir)
-            albumDB = generateAlbumDataFromMP3s(mp3s, progressFun)
+            mp3s = id3tags.iterMP3s(af.musicPath, options.include or ("*.mp3",),
+                options.exclude, options.followLinks)
+            index = openScanIndex(af.musicPath)
+            if options.rescan:
+                index.clear()
+            albumDB = af.profile("scan", generateAlbumDataFromMP3s, mp3s, progressFun, index,
+                options.scanProcesses, af.stats)
+            index.close()
         af.runSearch(albumDB)
+        if options.statsJSON:
+            af.stats.dump(options.statsJSON)
     else:
         NewAlbumFinderGUI.main()
     
@@ -4,16 +4,107 @@ import wx.grid, webbrowser
 
 import NewAlbumFinder, id3tags
 
-import os
+import os, threading, time, traceback
 
 DEBUG = False
 
-SHOW_ALL_ALBUMS = WRITE_LOGFILE = USE_TREE = False
+PROGRESS_INTERVAL = 0.1     # seconds between progress dialog updates from the worker thread
+
+SHOW_ALL_ALBUMS = WRITE_LOGFILE = USE_TREE = RESUME = PROFILE = False
 
 class Options:
     "We'll fill this class's members to match the command line arguments"
     pass
 
+class AlbumTable(wx.grid.GridTableBase):
+    """
+    The artist/album pairs of an albumDB as a table for a virtual grid, so
+    the grid only asks for the cells it's showing instead of holding one
+    for every album.  The rows can be sorted by either column and filtered
+    to those whose artist or album contains some text, without rebuilding
+    the grid; the albumDB itself is left alone.
+    """
+    colLabels = ('Artist', 'Album')
+
+    def __init__(self):
+        wx.grid.GridTableBase.__init__(self)
+        self.rows = []      # (artist, album, lowercase artist, lowercase album)
+        self.view = []      # the rows that pass the filter, in sort order
+        self.sortCol = 0
+        self.descending = False
+        self.filterText = u''
+        self.gridRows = 0   # number of rows the grid knows about
+
+    def GetNumberRows(self):
+        return len(self.view)
+
+    def GetNumberCols(self):
+        return len(self.colLabels)
+
+    def GetColLabelValue(self, col):
+        return self.colLabels[col]
+
+    def IsEmptyCell(self, row, col):
+        return False
+
+    def GetValue(self, row, col):
+        if row < len(self.view):
+            return self.view[row][col]
+        return u''
+
+    def SetValue(self, row, col, value):
+        pass    # read only
+
+    def SetAlbumDB(self, albumDB, grid):
+        "Show the albums in albumDB in grid"
+        rows = []
+        for artist in albumDB.keys():
+            artistKey = artist.lower()
+            for album in albumDB[artist]:
+                rows.append((artist, album, artistKey, album.lower()))
+        self.rows = rows
+        self.Sort(self.sortCol, self.descending, grid)
+
+    def Sort(self, col, descending, grid):
+        "Sort the rows by column col, then by the other column"
+        self.sortCol = col
+        self.descending = descending
+        self.rows.sort(key=lambda row: (row[2 + col], row[3 - col]), reverse=descending)
+        self.view = self.rows
+        filterText, self.filterText = self.filterText, u''
+        self.Filter(filterText, grid)
+
+    def Filter(self, text, grid):
+        "Show only the rows whose artist or album contains text (ignoring case)"
+        text = text.lower()
+        # If text contains the old filter text (e.g. more was typed), only the rows shown now can match
+        if self.filterText in text:
+            rows = self.view
+        else:
+            rows = self.rows
+        if text:
+            self.view = [row for row in rows if text in row[2] or text in row[3]]
+        else:
+            self.view = self.rows
+        self.filterText = text
+        self.RowsChanged(grid)
+
+    def RowsChanged(self, grid):
+        "Tell grid how many rows there are now, and to redraw them"
+        oldCount, newCount = self.gridRows, len(self.view)
+        self.gridRows = newCount
+        grid.BeginBatch()
+        if newCount < oldCount:
+            msg = wx.grid.GridTableMessage(self, wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED,
+                newCount, oldCount - newCount)
+            grid.ProcessTableMessage(msg)
+        elif newCount > oldCount:
+            msg = wx.grid.GridTableMessage(self, wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED,
+                newCount - oldCount)
+            grid.ProcessTableMessage(msg)
+        grid.EndBatch()
+        grid.ForceRefresh()
+
 class MyApp(wx.App):
     def __init__(self, redirect=False, filename=None):
         wx.App.__init__(self, redirect, filename)
@@ -22,9 +113,18 @@ class MyApp(wx.App):
 class MainWindow(wx.Frame):
     
     firstScan = True
+    canSearch = False   # set once a scan has found some albums
+    progressDlg = None
+    finder = None       # the AlbumFinder running the current search
+    worker = None       # thread doing the current scan or search
     
     def __init__(self, parent, title, size):
         wx.Frame.__init__(self, parent, title=title, size=size)
+        # The scans and searches run on a worker thread so the window stays
+        #  responsive; setting cancel asks the worker to stop
+        self.cancel = threading.Event()
+        self.lastProgress = 0
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
         self.panel = wx.Panel(self, wx.ID_ANY)
         
@@ -64,12 +164,18 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_CHECKBOX, self.EvtUseTree, self.use_tree)
         mainSizer.Add(self.use_tree, flag=wx.ALL, border=10)
         
+        # Add checkbox for profiling the scan and search
+        self.profileCheck = wx.CheckBox(self.panel, label='Profile the scan and search (saved in your output folder)')
+        self.Bind(wx.EVT_CHECKBOX, self.EvtProfile, self.profileCheck)
+        mainSizer.Add(self.profileCheck, flag=wx.ALL, border=10)
+        
         # Add directory selector for top-level MP3 path
         dirSelectLbl = wx.StaticText(self.panel, label='Top-level MP3 directory:')
         horSizer1.Add(dirSelectLbl)
         self.mp3DirBox = wx.TextCtrl(self.panel, size=(300,-1), style=wx.TE_READONLY)
         horSizer1.Add(self.mp3DirBox)
         mp3BrowseBtn = wx.Button(self.panel, label="Browse")
+        self.mp3BrowseBtn = mp3BrowseBtn
         self.Bind(wx.EVT_BUTTON, self.EvtMp3Browse, mp3BrowseBtn)
         horSizer1.Add(mp3BrowseBtn)
         mainSizer.Add(horSizer1, flag=wx.ALL, border=10)
@@ -89,6 +195,11 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_CHECKBOX, self.EvtLogFile, self.logFileCheck)
         iTparBoxSizer.Add(self.logFileCheck, flag=wx.ALL, border=10)
         
+        # Add Checkbox to pick up an interrupted search where it left off
+        self.resumeCheck = wx.CheckBox(self.panel, label="Resume interrupted search")
+        self.Bind(wx.EVT_CHECKBOX, self.EvtResume, self.resumeCheck)
+        iTparBoxSizer.Add(self.resumeCheck, flag=wx.ALL, border=10)
+        
         # Add spin control for setting min year
         yearLabel = wx.StaticText(self.panel, label='Earliest year to include:')
         self.yearSpin = wx.SpinCtrl(self.panel, min=1900, max=2100, value='1900')
@@ -116,40 +227,138 @@ class MainWindow(wx.Frame):
         # Add grid for displaying users current artist/album collection
         self.AddGrid()
         
+        # Add list the new albums are added to as the search finds them
+        self.AddNewAlbumList()
+        
         self.panel.SetSizerAndFit(mainSizer)
         self.Show()
         
     def AddGrid(self):
-        # Add grid to hold found albums
+        # Add box for filtering the albums shown in the grid
+        filterSizer = wx.BoxSizer(wx.HORIZONTAL)
+        filterLbl = wx.StaticText(self.panel, label='Show artists/albums containing:')
+        filterSizer.Add(filterLbl, flag=wx.ALIGN_CENTER_VERTICAL)
+        self.filterBox = wx.TextCtrl(self.panel, size=(200,-1))
+        self.Bind(wx.EVT_TEXT, self.EvtFilter, self.filterBox)
+        filterSizer.Add(self.filterBox)
+        self.mainSizer.Add(filterSizer, flag=wx.ALL, border=5)
+        self.filterSizer = filterSizer
+        self.mainSizer.Show(self.filterSizer, False)
+        
+        # Add grid to hold found albums, a virtual one that only asks the table for the rows it shows
         albumGrid = wx.grid.Grid(self.panel , size=(-1, 200))
-        albumGrid.AutoSize()
-        albumGrid.CreateGrid(0,2)
-        albumGrid.SetColLabelValue(0, 'Artist')
-        albumGrid.SetColLabelValue(1, 'Album')
+        self.albumTable = AlbumTable()
+        albumGrid.SetTable(self.albumTable, False)
+        albumGrid.EnableEditing(False)
+        albumGrid.SetColSize(0, 200)
+        albumGrid.SetColSize(1, 300)
+        self.Bind(wx.grid.EVT_GRID_LABEL_LEFT_CLICK, self.EvtGridLabelClick, albumGrid)
         self.mainSizer.Add(albumGrid, flag=wx.EXPAND)
         self.albumGrid = albumGrid
         self.mainSizer.Show(self.albumGrid, False) # don't show it until we've loaded it with data
  
+    def AddNewAlbumList(self):
+        newAlbumList = wx.ListCtrl(self.panel, size=(-1, 200), style=wx.LC_REPORT|wx.LC_SINGLE_SEL)
+        for col, label in enumerate(("Artist", "Year", "Album", "Tracks")):
+            newAlbumList.InsertColumn(col, label)
+        self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.EvtNewAlbumActivated, newAlbumList)
+        self.mainSizer.Add(newAlbumList, flag=wx.EXPAND)
+        self.newAlbumList = newAlbumList
+        self.newAlbumLinks = []     # iTunes page of each album in the list
+        self.mainSizer.Show(self.newAlbumList, False) # don't show it until the first search
+
+    def RunInBackground(self, work, done, *args):
+        """Run work(*args) on a worker thread, then done(result) back on the
+        UI thread.  The window stays responsive meanwhile, with the controls
+        that would start another scan or search disabled."""
+        self.cancel.clear()
+        self.lastProgress = 0
+        self.EnableControls(False)
+        def run():
+            try:
+                result = work(*args)
+            except Exception, e:
+                traceback.print_exc()
+                wx.CallAfter(self.WorkFailed, e)
+            else:
+                wx.CallAfter(self.WorkDone, done, result)
+        self.worker = threading.Thread(target=run)
+        self.worker.daemon = True   # don't keep the app alive once the window's closed
+        self.worker.start()
+
+    def WorkFinished(self):
+        self.worker = None
+        self.finder = None
+        if self.progressDlg:
+            self.progressDlg.Destroy()      # make sure progress dialog goes away
+            self.progressDlg = None
+        self.EnableControls(True)
+
+    def WorkDone(self, done, result):
+        self.WorkFinished()
+        done(result)
+
+    def WorkFailed(self, error):
+        self.WorkFinished()
+        wx.MessageBox("Something went wrong: %s" % error, NewAlbumFinder.appName, wx.ICON_ERROR)
+
+    def EnableControls(self, enable):
+        self.mp3BrowseBtn.Enable(enable)
+        self.use_tree.Enable(enable)
+        self.searchButton.Enable(enable and self.canSearch)
+
+    def Cancel(self):
+        "Ask the worker thread to stop"
+        self.cancel.set()
+        if self.finder:
+            self.finder.cancel.set()
+
     def EvtSearchiTunes(self, evt):
         if DEBUG: print 'Clicked search button'
         # Load options
         opts = Options()
         opts.tunesDir = self.mp3DirBox.GetValue()
         opts.ignorePrevious = SHOW_ALL_ALBUMS
+        opts.resume = RESUME
         opts.albums_from_dir_structure = USE_TREE
         opts.MINTRACKS = int(self.trackSpin.GetValue())
         opts.outdir = "Desktop"
         opts.writeLogfile = DEBUG or WRITE_LOGFILE
         opts.minYear = int(self.yearSpin.GetValue())
+        opts.pageSize = NewAlbumFinder.REPORT_PAGE_SIZE
+        opts.exports = []
+        opts.workers = NewAlbumFinder.WORKERS
+        opts.catalog = "itunes"
+        opts.catalogURL = None
+        opts.http = NewAlbumFinder.HTTP_ENGINE
+        opts.maxPerHost = NewAlbumFinder.MAX_PER_HOST
+        opts.rate = NewAlbumFinder.RATE
+        opts.retries = NewAlbumFinder.RETRIES
+        opts.timeout = NewAlbumFinder.TIMEOUT
+        opts.cacheDays = NewAlbumFinder.CACHE_DAYS
+        opts.cacheMB = NewAlbumFinder.CACHE_MB
+        opts.refresh = opts.offline = False
+        opts.profile = PROFILE
+        opts.profiler = NewAlbumFinder.PROFILER
+        opts.profileTop = NewAlbumFinder.PROFILE_TOP
         if DEBUG:
             print opts.__dict__
             return
-        finder = NewAlbumFinder.AlbumFinder(opts, self.progressFun)
+        finder = NewAlbumFinder.AlbumFinder(opts, self.progressFun, self.artistDoneFun)
+        self.finder = finder
+        self.newAlbumList.DeleteAllItems()
+        self.newAlbumLinks = []
+        self.mainSizer.Show(self.newAlbumList, True)
+        self.mainSizer.Layout()
         self.progressDlg = wx.ProgressDialog(title="iTunes Search in Progress", 
             message="Searching iTunes by artist...", parent=self, 
             maximum=len(self.albumDB.keys()), style=wx.PD_CAN_ABORT|wx.PD_ELAPSED_TIME|wx.PD_AUTO_HIDE)
-        newCDcount = finder.runSearch(self.albumDB)
-        self.progressDlg.Destroy()      # make sure progress dialog goes away
+        self.RunInBackground(finder.runSearch, lambda newCDcount: self.SearchDone(finder, newCDcount),
+            self.albumDB)
+
+    def SearchDone(self, finder, newCDcount):
+        if newCDcount is None:
+            return      # the search was cancelled
         if newCDcount == 0:
             msg = "No new albums were found."
             wx.MessageBox(msg, "iTunes Search Finished")
@@ -159,31 +368,75 @@ class MainWindow(wx.Frame):
             webbrowser.open(finder.outFilePath)
    
     def progressFun(self, i, msg):
-        (keep_going, x) = self.progressDlg.Update(i, msg)
+        """Called on the worker thread: show progress on the UI thread (at most
+        every PROGRESS_INTERVAL seconds) and return False if the user has
+        cancelled"""
+        now = time.time()
+        if now - self.lastProgress >= PROGRESS_INTERVAL:
+            self.lastProgress = now
+            wx.CallAfter(self.ShowProgress, i, msg)
+        return not self.cancel.is_set()
+
+    def pulseFun(self, i, msg):
+        "Like progressFun, for when we don't know how many steps there will be"
+        return self.progressFun(None, msg)
+
+    def ShowProgress(self, i, msg):
+        if not self.progressDlg or self.cancel.is_set():
+            return
+        if i is None:
+            (keep_going, x) = self.progressDlg.Pulse(msg)
+        else:
+            (keep_going, x) = self.progressDlg.Update(i, msg)
         if not keep_going:
+            self.Cancel()
             self.progressDlg.Destroy()
-        return keep_going      
+            self.progressDlg = None
 
+    def artistDoneFun(self, artist, newCDs):
+        "Called on the worker thread as the search finishes each artist"
+        if newCDs:
+            wx.CallAfter(self.AddNewAlbums, artist, list(newCDs))
+
+    def AddNewAlbums(self, artist, newCDs):
+        "Add the new CDs found for artist to the new album list"
+        for year, title, genre, tracks, image, albumLink in newCDs:
+            row = self.newAlbumList.InsertStringItem(self.newAlbumList.GetItemCount(), artist)
+            self.newAlbumList.SetStringItem(row, 1, year and str(year) or "")
+            self.newAlbumList.SetStringItem(row, 2, title)
+            self.newAlbumList.SetStringItem(row, 3, str(tracks))
+            self.newAlbumLinks.append(albumLink)
+
+    def EvtNewAlbumActivated(self, evt):
+        webbrowser.open(self.newAlbumLinks[evt.GetIndex()])
         
-    def ScanDirs(self):
-        albumDB = NewAlbumFinder.generateAlbumDataFromPath(self.mp3DirBox.GetValue())
-        self.albumDB = albumDB  # save the album data
-        artists = albumDB.keys()
-        artists.sort()
-        self.artists = artists
-        albumCount = 0
-        for artist in artists:
-            albumCount += len(albumDB[artist])
-        msg = "Found %d artists and %d albums" % (len(artists), albumCount)
-        wx.MessageBox(msg, 'Directory scan complete')
-        return albumCount
+
+    def Profile(self, phase, fun, *args):
+        "Return fun(*args), profiled as phase if profiling is checked"
+        if not PROFILE:
+            return fun(*args)
+        profiler = NewAlbumFinder.PhaseProfiler(NewAlbumFinder.findOutputDir("Desktop"),
+            NewAlbumFinder.appName, NewAlbumFinder.PROFILE_TOP, NewAlbumFinder.PROFILER == "sampling")
+        return profiler.run(phase, fun, *args)
+
+    def ScanDirs(self, path):
+        "Runs on the worker thread"
+        return self.Profile("scan", NewAlbumFinder.generateAlbumDataFromPath, path)
         
-    def ScanMp3s(self):
-        mp3s = id3tags.findMP3s(self.mp3DirBox.GetValue())
-        self.progressDlg = wx.ProgressDialog(title="Generating album list", message="MP3s scanned: ", 
-            parent=self, maximum=len(mp3s), style=wx.PD_CAN_ABORT|wx.PD_ELAPSED_TIME|wx.PD_AUTO_HIDE)
-        albumDB = NewAlbumFinder.generateAlbumDataFromMP3s(mp3s, self.progressFun)
-        self.progressDlg.Destroy()      # make sure progress dialog goes away
+    def ScanMp3s(self, path):
+        "Runs on the worker thread"
+        # Tags are read while the folders are still being walked, so we
+        #  don't know the total number of MP3s up front
+        mp3s = id3tags.iterMP3s(path)
+        index = NewAlbumFinder.openScanIndex(path)
+        albumDB = self.Profile("scan", NewAlbumFinder.generateAlbumDataFromMP3s, mp3s, self.pulseFun,
+            index, NewAlbumFinder.SCAN_PROCESSES)
+        index.close()
+        return albumDB
+
+    def ScanDone(self, albumDB, title):
+        if self.cancel.is_set():
+            return      # keep the album list we had, if any
         self.albumDB = albumDB  # save the album data
         artists = albumDB.keys()
         artists.sort()
@@ -192,31 +445,33 @@ class MainWindow(wx.Frame):
         for artist in artists:
             albumCount += len(albumDB[artist])
         msg = "Found %d artists and %d albums" % (len(artists), albumCount)
-        wx.MessageBox(msg, 'MP3 scan complete')
-        return albumCount
+        wx.MessageBox(msg, title)
+        self.canSearch = albumCount > 0
+        self.searchButton.Enable(self.canSearch)
+        if albumCount > 0:
+            self.show_artist_album_grid()
         
     def show_artist_album_grid(self):
-        i = 0
         if self.firstScan:
+            self.mainSizer.Show(self.filterSizer, True)
             self.mainSizer.Show(self.albumGrid, True)
             self.mainSizer.Show(self.searchButton, True)
             self.mainSizer.Show(self.iTparBoxSizer, True)
             self.mainSizer.Layout()
             self.firstScan = False
-        elif self.albumGrid.GetNumberRows():
-            self.albumGrid.ClearGrid()
-            self.albumGrid.DeleteRows(0, self.albumGrid.GetNumberRows())
-        # Fill in grid with artist/album data
-        for artist in self.artists:
-            albums = self.albumDB[artist]
-            albums.sort()
-            for album in albums:
-                self.albumGrid.AppendRows(1)
-                self.albumGrid.SetCellValue(i, 0, artist)
-                self.albumGrid.SetCellValue(i, 1, album)
-                i = i + 1
-        self.albumGrid.Fit()
-        self.albumGrid.ForceRefresh()        
+        # The grid asks the table for the cells it shows, so this is quick however many albums there are
+        self.albumTable.SetAlbumDB(self.albumDB, self.albumGrid)
+
+    def EvtFilter(self, evt):
+        self.albumTable.Filter(self.filterBox.GetValue(), self.albumGrid)
+
+    def EvtGridLabelClick(self, evt):
+        # Sort by the column whose label was clicked; click again to reverse the order
+        col = evt.GetCol()
+        if col < 0:
+            return
+        descending = col == self.albumTable.sortCol and not self.albumTable.descending
+        self.albumTable.Sort(col, descending, self.albumGrid)
             
     def EvtMp3Browse(self, evt):
         if DEBUG: print 'Browsing for top-level MP3 directory'
@@ -227,13 +482,15 @@ class MainWindow(wx.Frame):
         dlg.Destroy()
         if status != wx.ID_OK:
             return      # user cancelled w/out selecting directory
+        path = self.mp3DirBox.GetValue()
         if USE_TREE:
-            albumCount = self.ScanDirs()
+            self.RunInBackground(self.ScanDirs,
+                lambda albumDB: self.ScanDone(albumDB, 'Directory scan complete'), path)
         else:
-            albumCount = self.ScanMp3s()
-        if albumCount > 0:
-            self.searchButton.Enable(True)
-            self.show_artist_album_grid()
+            self.progressDlg = wx.ProgressDialog(title="Generating album list", message="MP3s scanned: ", 
+                parent=self, style=wx.PD_CAN_ABORT|wx.PD_ELAPSED_TIME|wx.PD_AUTO_HIDE)
+            self.RunInBackground(self.ScanMp3s,
+                lambda albumDB: self.ScanDone(albumDB, 'MP3 scan complete'), path)
 
     def EvtAllAlbums(self, evt):
         global SHOW_ALL_ALBUMS
@@ -245,6 +502,16 @@ class MainWindow(wx.Frame):
         WRITE_LOGFILE = evt.Checked()
         if DEBUG: print "Write Logfile is ", WRITE_LOGFILE
 
+    def EvtResume(self, evt):
+        global RESUME
+        RESUME = evt.Checked()
+        if DEBUG: print "Resume is ", RESUME
+
+    def EvtProfile(self, evt):
+        global PROFILE
+        PROFILE = evt.Checked()
+        if DEBUG: print "Profile is ", PROFILE
+
     def EvtUseTree(self, evt):
         global USE_TREE
         USE_TREE = evt.Checked()
@@ -252,6 +519,11 @@ class MainWindow(wx.Frame):
     def Exit(self, evt):
         self.Close(True)
 
+    def OnClose(self, evt):
+        # Stop any scan or search; its thread won't keep us from exiting
+        self.Cancel()
+        evt.Skip()
+
     def ShowAbout(self, evt):
         # First we create and fill the info object
         info = wx.AboutDialogInfo()
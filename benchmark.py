@@ -0,0 +1,338 @@
+#!/usr/bin/python
+#
+"""
+Times the hot paths of NewAlbumFinder on a synthetic MP3 library:
+finding the MP3s, reading their tags, building the album list from the
+folder tree, normalizing album titles and artist names, and searching a
+local mock store (see mockstore.py) for every artist.
+
+The library is written once to --tree and reused by later runs with the
+same --files and --seed.  Results are written as JSON to --output, so runs
+on different commits can be compared:
+    python benchmark.py --files 10000 --output before.json
+    (check out another commit)
+    python benchmark.py --files 10000 --output after.json --baseline before.json
+    python benchmark.py --baseline before.json after.json   (just compare)
+"""
+
+import os, sys, struct, random, json, time, timeit, platform, subprocess
+import optparse, shutil, tempfile
+import id3tags, mockstore
+import NewAlbumFinder
+
+DEBUG = False
+
+FORMAT = 1      # of the results file
+
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 4
+MISC_EVERY = 7      # every 7th album's tracks go in a "Misc" folder, not one named for the album
+
+# The kinds of tag we give the synthetic MP3s, in turn
+TAG_KINDS = ("v1", "v2.3 latin-1", "v2.3 utf-16", "v2.4 utf-8", "v2.4 utf-16be", "v2.3+v1")
+
+# Words the synthetic artist names and album titles are made from, some
+# with accents and punctuation so title and name normalization have work to do
+WORDS = (u"Blue", u"Night", u"River", u"Caf\xe9", u"Stone", u"Echo", u"Golden",
+    u"M\xf6tley", u"Road", u"Heart", u"Fire", u"Se\xf1or", u"Rain", u"Days",
+    u"& the", u"Live!", u"(Remastered)", u"Don't", u"Vol. 2", u"Sky")
+
+def syncsafe(n):
+    "Return n as a 4 byte ID3v2 syncsafe integer"
+    return struct.pack(">4B", (n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f)
+
+def encodeText(text, encoding):
+    "Return the body of an ID3v2 text frame holding unicode text in the given ID3 encoding"
+    if encoding == 0:
+        return "\x00" + text.encode("latin-1", "replace")
+    if encoding == 1:
+        return "\x01" + text.encode("utf-16")     # with a BOM
+    if encoding == 2:
+        return "\x02" + text.encode("utf-16-be")
+    return "\x03" + text.encode("utf-8")
+
+def v2Tag(frames, version, encoding):
+    "Return an ID3v2.3 or v2.4 tag holding the [(frame id, unicode text)] frames"
+    body = []
+    for frameId, text in frames:
+        data = encodeText(text, encoding)
+        if version == 4:
+            size = syncsafe(len(data))
+        else:
+            size = struct.pack(">L", len(data))
+        body.append(frameId + size + "\x00\x00" + data)
+    body.append("\x00" * 256)    # padding, as taggers leave
+    body = "".join(body)
+    return "ID3" + chr(version) + "\x00\x00" + syncsafe(len(body)) + body
+
+def v1Tag(title, artist, album, year, track):
+    "Return an ID3v1.1 tag"
+    def field(text, size):
+        return text.encode("latin-1", "replace")[:size].ljust(size, "\x00")
+    return ("TAG" + field(title, 30) + field(artist, 30) + field(album, 30) +
+        field(year, 4) + "\x00" * 28 + "\x00" + chr(track) + "\x0c")
+
+def fakeAudio(rand):
+    "Return a few MPEG frame headers' worth of bytes to stand in for the audio"
+    return ("\xff\xfb\x90\x64" + "\x00" * 413) * rand.randint(1, 4)
+
+def syntheticMP3(kind, artist, album, title, year, track, rand):
+    "Return the contents of an MP3 with the given kind of tag (see TAG_KINDS)"
+    frames = [("TIT2", title), ("TPE1", artist), ("TALB", album),
+        ("TRCK", u"%d/%d" % (track, TRACKS_PER_ALBUM))]
+    head = tail = ""
+    if kind == "v1":
+        tail = v1Tag(title, artist, album, year, track)
+    elif kind == "v2.3 latin-1":
+        head = v2Tag(frames + [("TYER", year)], 3, 0)
+    elif kind == "v2.3 utf-16":
+        head = v2Tag(frames + [("TYER", year)], 3, 1)
+    elif kind == "v2.4 utf-8":
+        head = v2Tag(frames + [("TDRC", year)], 4, 3)
+    elif kind == "v2.4 utf-16be":
+        head = v2Tag(frames + [("TDRC", year)], 4, 2)
+    else:
+        head = v2Tag(frames + [("TYER", year)], 3, 1)
+        tail = v1Tag(title, artist, album, year, track)
+    return head + fakeAudio(rand) + tail
+
+def randomName(rand, words):
+    return u" ".join([rand.choice(WORDS) for i in range(words)])
+
+def makeSyntheticTree(root, files, seed=1):
+    """
+    Write a library of about files synthetic MP3s under root, laid out
+    artist/album/track.mp3 as rippers do, with the tag kinds in TAG_KINDS
+    spread over it.  Returns the number of files written.
+    """
+    rand = random.Random(seed)
+    written = 0
+    artistNum = 0
+    while written < files:
+        artist = u"%s %d" % (randomName(rand, 2), artistNum)
+        artistDir = os.path.join(root, artist.encode("utf-8"))
+        for albumNum in range(ALBUMS_PER_ARTIST):
+            album = u"%s %d" % (randomName(rand, rand.randint(1, 4)), albumNum)
+            year = unicode(rand.randint(1960, 2016))
+            if (artistNum * ALBUMS_PER_ARTIST + albumNum) % MISC_EVERY == 0:
+                albumDir = os.path.join(artistDir, "Misc")
+            else:
+                albumDir = os.path.join(artistDir, album.encode("utf-8").replace("/", "-"))
+            if not os.path.isdir(albumDir):
+                os.makedirs(albumDir)
+            for track in range(1, TRACKS_PER_ALBUM + 1):
+                kind = TAG_KINDS[written % len(TAG_KINDS)]
+                data = syntheticMP3(kind, artist, album, randomName(rand, 3), year, track, rand)
+                f = open(os.path.join(albumDir, "%d-%02d.mp3" % (albumNum, track)), "wb")
+                f.write(data)
+                f.close()
+                written += 1
+                if written >= files:
+                    return written
+        artistNum += 1
+    return written
+
+def prepareTree(root, files, seed):
+    "Make the synthetic library in root unless the one there already has these parameters"
+    marker = os.path.join(root, "benchmark-tree.json")
+    params = {"files": files, "seed": seed, "kinds": list(TAG_KINDS)}
+    if os.path.exists(marker) and json.load(open(marker)) == params:
+        return
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    print "Writing %d synthetic MP3s to %s" % (files, root)
+    makeSyntheticTree(root, files, seed)
+    json.dump(params, open(marker, "w"))
+
+class Quiet:
+    "Context manager sending what's printed to stdout nowhere"
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def timeRuns(fun, repeat, setup=None):
+    "Call fun repeat times, after setup if given, and return the list of seconds each call took"
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = timeit.default_timer()
+        fun()
+        times.append(timeit.default_timer() - start)
+    return times
+
+def summarize(times, items):
+    times = sorted(times)
+    result = {"min": times[0], "median": times[len(times) // 2], "runs": times, "items": items}
+    if items:
+        result["perItemMicroseconds"] = times[0] / items * 1e6
+    return result
+
+def gitCommit():
+    "Return the commit the code under test is checked out at, or None if we can't tell"
+    try:
+        out = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+        return out.strip() or None
+    except OSError:
+        return None
+
+def runBenchmarks(options):
+    "Run the benchmarks selected by options and return the results dict"
+    root = os.path.abspath(options.tree)
+    prepareTree(root, options.files, options.seed)
+    workDir = tempfile.mkdtemp(prefix="NewAlbumFinderBench")
+    results = {}
+    def record(name, times, items):
+        results[name] = summarize(times, items)
+        print "%-34s %10.4fs  (median %.4fs, %d items)" % (name, results[name]["min"],
+            results[name]["median"], items)
+
+    try:
+        mp3s = id3tags.findMP3s(root)
+        record("findMP3s", timeRuns(lambda: id3tags.findMP3s(root), options.repeat), len(mp3s))
+
+        scan = lambda: NewAlbumFinder.generateAlbumDataFromMP3s(mp3s)
+        record("generateAlbumDataFromMP3s", timeRuns(scan, options.repeat), len(mp3s))
+
+        if options.processes > 1:
+            scan = lambda: NewAlbumFinder.generateAlbumDataFromMP3s(mp3s, processes=options.processes)
+            record("generateAlbumDataFromMP3s/%dproc" % options.processes,
+                timeRuns(scan, options.repeat), len(mp3s))
+
+        indexPath = os.path.join(workDir, "index.db")
+        def indexedScan():
+            index = NewAlbumFinder.ScanIndex(indexPath)
+            NewAlbumFinder.generateAlbumDataFromMP3s(mp3s, index=index)
+            index.close()
+        indexedScan()   # so the timed runs find everything indexed
+        record("generateAlbumDataFromMP3s/indexed", timeRuns(indexedScan, options.repeat), len(mp3s))
+
+        fromPath = lambda: NewAlbumFinder.generateAlbumDataFromPath(root)
+        record("generateAlbumDataFromPath", timeRuns(fromPath, options.repeat), len(mp3s))
+
+        albumDB = NewAlbumFinder.generateAlbumDataFromMP3s(mp3s)
+        titles = []
+        for artist in albumDB.keys():
+            titles.extend(albumDB[artist])
+        # Titles nobody has normalized yet, so the memo cache doesn't hide the work
+        coldTitles = [[u"%s %d" % (title, run) for title in titles] for run in range(options.repeat)]
+        def standardizeCold():
+            for title in coldTitles.pop():
+                NewAlbumFinder.standardizeAlbumTitle(title)
+        record("standardizeAlbumTitle", timeRuns(standardizeCold, options.repeat), len(titles))
+        def standardizeWarm():
+            for title in titles:
+                NewAlbumFinder.standardizeAlbumTitle(title)
+        record("standardizeAlbumTitle/memoized", timeRuns(standardizeWarm, options.repeat), len(titles))
+
+        # As the scan adds them: once for every track of each album
+        trackAlbums = [(artist, album) for artist in albumDB.keys() for album in albumDB[artist]] * 10
+        def buildAlbumDB():
+            db = id3tags.AlbumDB()
+            for artist, album in trackAlbums:
+                db.add(artist, album)
+        record("AlbumDB.add", timeRuns(buildAlbumDB, options.repeat), len(trackAlbums))
+
+        artists = sorted(albumDB.keys())
+        pairs = zip(artists, [artist.upper() for artist in artists[1:] + artists[:1]])
+        def matchArtists():
+            for artist1, artist2 in pairs:
+                NewAlbumFinder.artistNamesMatch(artist1, artist2)
+        record("artistNamesMatch", timeRuns(matchArtists, options.repeat), len(pairs))
+
+        if options.artists:
+            searchDB = id3tags.AlbumDB()
+            for artist in artists[:options.artists]:
+                for album in albumDB[artist]:
+                    searchDB.add(artist, album)
+            store = mockstore.startMockStore(latency=options.latency,
+                errorRate=options.errorRate, albums=options.albums)
+            os.environ["HOME"] = workDir
+            os.mkdir(os.path.join(workDir, "Desktop"))
+            searchOptions, args = NewAlbumFinder.parseCmdLine(["-n", "-i", "-t", workDir,
+                "--catalog-url", store.url(), "--cache-days", "0", "--rate", "0",
+                "--workers", str(options.workers), "--http", options.http])
+            def search():
+                finder = NewAlbumFinder.AlbumFinder(searchOptions, lambda i, msg: True)
+                with Quiet():
+                    finder.runSearch(searchDB)
+            def removeHistory():
+                histFile = os.path.join(workDir, "NewAlbumFinder.dat")
+                if os.path.exists(histFile):
+                    os.remove(histFile)
+            record("runSearch", timeRuns(search, options.repeat, removeHistory), len(searchDB.keys()))
+            store.shutdown()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+def compareResults(baseline, current):
+    "Print how the min time of each benchmark in current compares to baseline"
+    print "%-34s %10s %10s %8s" % ("benchmark", "baseline", "current", "change")
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        old = baseline["results"].get(name)
+        new = current["results"].get(name)
+        if old is None or new is None:
+            print "%-34s %10s %10s" % (name, old and "%.4f" % old["min"] or "-",
+                new and "%.4f" % new["min"] or "-")
+            continue
+        change = (new["min"] - old["min"]) / old["min"] * 100 if old["min"] else 0.0
+        print "%-34s %10.4f %10.4f %+7.1f%%" % (name, old["min"], new["min"], change)
+    if baseline.get("params") != current.get("params"):
+        print "Warning: the runs used different parameters, so the times may not be comparable"
+
+def parseCmdLine():
+    parser = optparse.OptionParser(usage="%prog [options] [results.json]")
+    parser.add_option("-f", "--files", type="int", dest="files", default=10000,
+        help="number of synthetic MP3s [default: %default]")
+    parser.add_option("--seed", type="int", dest="seed", default=1,
+        help="random seed for the synthetic library [default: %default]")
+    parser.add_option("--tree", type="string", dest="tree",
+        default=os.path.join(tempfile.gettempdir(), "NewAlbumFinderBenchTree"),
+        help="where to keep the synthetic library [default: %default]", metavar="FOLDER")
+    parser.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+        help="times to run each benchmark; the fastest run is reported [default: %default]")
+    parser.add_option("-j", "--scan-processes", type="int", dest="processes", default=1,
+        help="also time the scan with this many processes [default: %default]")
+    parser.add_option("-a", "--artists", type="int", dest="artists", default=200,
+        help="artists to search the mock store for, 0 to skip the search [default: %default]")
+    parser.add_option("-w", "--workers", type="int", dest="workers", default=NewAlbumFinder.WORKERS,
+        help="concurrent searches [default: %default]")
+    parser.add_option("--http", type="choice", choices=["urllib", "keepalive"], dest="http",
+        default=NewAlbumFinder.HTTP_ENGINE, help="HTTP engine for the search [default: %default]")
+    parser.add_option("--latency", type="float", dest="latency", default=0.0,
+        help="mean mock store response delay in seconds [default: %default]")
+    parser.add_option("--error-rate", type="float", dest="errorRate", default=0.0,
+        help="fraction of mock store requests that fail [default: %default]")
+    parser.add_option("--albums", type="int", dest="albums", default=20,
+        help="albums the mock store returns per artist [default: %default]")
+    parser.add_option("-o", "--output", type="string", dest="output", default=None,
+        help="write the results to FILE as JSON", metavar="FILE")
+    parser.add_option("-b", "--baseline", type="string", dest="baseline", default=None,
+        help="compare the results with those saved in FILE", metavar="FILE")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options, args = parseCmdLine()
+    if args:
+        # Compare saved results instead of running the benchmarks
+        if not options.baseline:
+            NewAlbumFinder.err_exit("Give the results to compare with using --baseline")
+        compareResults(json.load(open(options.baseline)), json.load(open(args[0])))
+        sys.exit(0)
+    params = dict([(name, getattr(options, name)) for name in ("files", "seed", "repeat",
+        "processes", "artists", "workers", "http", "latency", "errorRate", "albums")])
+    current = {"format": FORMAT, "commit": gitCommit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "params": params, "results": runBenchmarks(options)}
+    if options.output:
+        f = open(options.output, "w")
+        json.dump(current, f, indent=2, sort_keys=True)
+        f.close()
+    if options.baseline:
+        compareResults(json.load(open(options.baseline)), current)
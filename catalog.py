@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+"Online music catalogs we can search for the albums by an artist"
+
+import urllib, json, re
+
+DEBUG = False
+
+class ITunesCatalog:
+    """
+    The iTunes store search web service.  Builds the URL that searches
+    for all the albums by an artist and turns the response into album
+    dicts with these keys:
+      artist       artist name as the store has it
+      title        album title
+      tracks       number of tracks
+      releaseDate  release date string starting with the 4 digit year, or ''
+      genre        primary genre
+      image        URL of the cover art
+      link         URL of the album's page in the store
+    Fetching, caching and retrying are up to the caller.
+    """
+    name = "itunes"
+
+    # Base URL for searching iTunes Store web service to find all albums by a given artist
+    URL = "http://ax.phobos.apple.com.edgesuite.net/WebObjects/MZStoreServices.woa/wa/wsSearch"
+
+    def __init__(self, url=None):
+        self.url = url or self.URL
+        self.urlTemplate = self.url + "?{artistTerm}&media=music&entity=album&attribute=artistTerm"
+
+    def searchURL(self, artist):
+        "Return the URL that searches the store for the albums by artist"
+        try:
+            artistTerm = urllib.urlencode({"term":artist})
+        except:
+            a = artist.encode('utf8','replace')
+            artistTerm = urllib.urlencode({"term":a})
+        return self.urlTemplate.replace("{artistTerm}", artistTerm)
+
+    # The fields of each search result we use, and the album keys they become
+    FIELDS = (('artistName', 'artist'), ('collectionName', 'title'),
+        ('trackCount', 'tracks'), ('releaseDate', 'releaseDate'),
+        ('primaryGenreName', 'genre'),
+        ('artworkUrl100', 'image'), ('collectionViewUrl', 'link'))
+    OPTIONAL_FIELDS = ('releaseDate',)
+
+    CHUNK_SIZE = 16 * 1024
+
+    def album(self, result):
+        "Return the album dict for one search result, dropping the fields we don't use"
+        album = {}
+        for field, key in self.FIELDS:
+            if field in self.OPTIONAL_FIELDS:
+                album[key] = result.get(field, '')
+            else:
+                album[key] = result[field]
+        return album
+
+    def parseStream(self, f):
+        """
+        Return the list of album dicts in the response read from file
+        object f.  The store sends {"resultCount": n, "results": [...]},
+        and for some artists the results run to hundreds of KB.  Rather
+        than read and decode the whole document, decode the results one at
+        a time as the response arrives, keeping only the fields we use.
+        """
+        albums = []
+        for result in iterJSONArray(f, "results", self.CHUNK_SIZE):
+            albums.append(self.album(result))
+        if DEBUG: print "found %d results" % len(albums)
+        return albums
+
+def iterJSONArray(f, key, chunkSize=16*1024):
+    """
+    Generate the elements of the array that is the value of key in the JSON
+    object read from file object f, decoding each one as soon as all of it
+    has been read.  Only the element being decoded and the unread part of
+    the current chunk are held in memory.  Raises ValueError if the
+    response is cut short or isn't an object with that array in it.
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    separator = re.compile(r'[\s,]*')
+    buf = ''
+    # Find the start of the array
+    while True:
+        chunk = f.read(chunkSize)
+        buf += chunk
+        match = start.search(buf)
+        if match:
+            pos = match.end()
+            break
+        if not chunk:
+            raise ValueError("no %s array in response" % key)
+        buf = buf[-(len(key) + 64):]    # keep enough to match a key split between chunks
+    while True:
+        pos = separator.match(buf, pos).end()
+        if buf[pos:pos+1] == ']':
+            return
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Probably an element cut off at the end of the buffer; read on
+            chunk = f.read(chunkSize)
+            if not chunk:
+                raise
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield element
+        pos = end
+        if pos > chunkSize:
+            buf = buf[pos:]
+            pos = 0
+
+# Backends by the name used to pick one on the command line
+BACKENDS = {ITunesCatalog.name: ITunesCatalog}
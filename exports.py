@@ -0,0 +1,184 @@
+#!/usr/bin/python
+#
+"Machine-readable exports of a search's results, written as artists are searched"
+
+import os, json, csv, sqlite3
+from histstore import replaceFile
+
+DEBUG = False
+
+FORMATS = ("jsonl", "csv", "sqlite")
+COMMIT_EVERY = 100      # artists between sqlite commits
+
+# Columns of the new CDs, in the order of the lists in newCDdb
+NEW_COLUMNS = ("year", "title", "genre", "tracks", "image", "link")
+
+def csvQuote(value):
+    "Return value as a quoted CSV field, doubling any quotes in it"
+    return u'"' + value.replace(u'"', u'""') + u'"'
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class Export:
+    """
+    Base class of the exports.  addArtist() is called with each artist as
+    its search completes, and writes that artist's results straight out,
+    so nothing is held back in memory.  Artists that couldn't be searched
+    are passed to addFailed().  Everything is written to temporary files
+    that only replace the real ones when close() is called at the end of a
+    completed search, so a reader never sees a half written export; if the
+    search is stopped, discard() throws them away and the previous run's
+    export is left as it was.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.artists = 0
+
+    def tmpPath(self, path):
+        return path + ".tmp"
+
+    def addArtist(self, artist, newCDs, iTunesAlbums, notFound):
+        """
+        Export the results for artist: newCDs, the new CDs as
+        [year, title, genre, tracks, image, albumLink] lists; iTunesAlbums,
+        the titles of all its albums found in iTunes; and notFound, the
+        titles of the albums we have that weren't found.
+        """
+        self.write(artist, newCDs, iTunesAlbums, notFound)
+        self.artists += 1
+
+    def addFailed(self, artist):
+        "Record that artist couldn't be searched"
+        self.writeFailed(artist)
+        self.artists += 1
+
+    def close(self):
+        "Finish the export and replace the previous one with it"
+        self.finish()
+        for path in self.paths:
+            replaceFile(self.tmpPath(path), path)
+        if DEBUG: print "exported %d artists to %s" % (self.artists, ", ".join(self.paths))
+
+    def discard(self):
+        "Finish the export and delete it, leaving the previous one in place"
+        self.finish()
+        for path in self.paths:
+            if os.path.exists(self.tmpPath(path)):
+                os.remove(self.tmpPath(path))
+
+class JSONLinesExport(Export):
+    """One JSON object per line for each artist, e.g.
+    {"artist": ..., "new": [{"year": ..., "title": ..., ...}], "iTunes": [...], "notFound": [...]}
+    or {"artist": ..., "failed": true} for an artist that couldn't be searched"""
+
+    def __init__(self, path):
+        Export.__init__(self, [path])
+        self.f = open(self.tmpPath(path), "w")
+
+    def write(self, artist, newCDs, iTunesAlbums, notFound):
+        record = {"artist": artist,
+            "new": [dict(zip(NEW_COLUMNS, newCD)) for newCD in newCDs],
+            "iTunes": list(iTunesAlbums), "notFound": list(notFound)}
+        self.writeRecord(record)
+
+    def writeFailed(self, artist):
+        self.writeRecord({"artist": artist, "failed": True})
+
+    def writeRecord(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        self.f.write("\n")
+
+    def finish(self):
+        self.f.close()
+
+class CSVExport(Export):
+    """UTF-8 CSV files with header rows: <base>-new.csv with a row per new
+    CD, <base>-itunes.csv with an artist,title row per album found in
+    iTunes, <base>-notfound.csv with one per album we have that wasn't and
+    <base>-failed.csv with an artist row for each artist that couldn't be
+    searched"""
+
+    def __init__(self, base):
+        self.newPath = base + "-new.csv"
+        self.iTunesPath = base + "-itunes.csv"
+        self.notFoundPath = base + "-notfound.csv"
+        self.failedPath = base + "-failed.csv"
+        Export.__init__(self, [self.newPath, self.iTunesPath, self.notFoundPath, self.failedPath])
+        self.files = []
+        self.newCSV = self.open(self.newPath, ("artist",) + NEW_COLUMNS)
+        self.iTunesCSV = self.open(self.iTunesPath, ("artist", "title"))
+        self.notFoundCSV = self.open(self.notFoundPath, ("artist", "title"))
+        self.failedCSV = self.open(self.failedPath, ("artist",))
+
+    def open(self, path, header):
+        f = open(self.tmpPath(path), "wb")
+        self.files.append(f)
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(header)
+        return writer
+
+    def write(self, artist, newCDs, iTunesAlbums, notFound):
+        artist = utf8(artist)
+        self.newCSV.writerows([[artist] + [utf8(value) for value in newCD] for newCD in newCDs])
+        self.iTunesCSV.writerows([[artist, utf8(title)] for title in iTunesAlbums])
+        self.notFoundCSV.writerows([[artist, utf8(title)] for title in notFound])
+
+    def writeFailed(self, artist):
+        self.failedCSV.writerow([utf8(artist)])
+
+    def finish(self):
+        for f in self.files:
+            f.close()
+
+class SQLiteExport(Export):
+    """A sqlite file with the tables new_albums (a row per new CD),
+    itunes_albums (artist, title for each album found in iTunes),
+    not_found (artist, title for each album we have that wasn't) and
+    failed (each artist that couldn't be searched)"""
+
+    def __init__(self, path):
+        Export.__init__(self, [path])
+        if os.path.exists(self.tmpPath(path)):
+            os.remove(self.tmpPath(path))   # left by an aborted run
+        self.conn = sqlite3.connect(self.tmpPath(path))
+        self.conn.execute("""CREATE TABLE new_albums (artist TEXT, year INTEGER,
+            title TEXT, genre TEXT, tracks INTEGER, image TEXT, link TEXT)""")
+        self.conn.execute("CREATE TABLE itunes_albums (artist TEXT, title TEXT)")
+        self.conn.execute("CREATE TABLE not_found (artist TEXT, title TEXT)")
+        self.conn.execute("CREATE TABLE failed (artist TEXT)")
+
+    def write(self, artist, newCDs, iTunesAlbums, notFound):
+        self.conn.executemany("INSERT INTO new_albums VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [[artist] + list(newCD) for newCD in newCDs])
+        self.conn.executemany("INSERT INTO itunes_albums VALUES (?, ?)",
+            [(artist, title) for title in iTunesAlbums])
+        self.conn.executemany("INSERT INTO not_found VALUES (?, ?)",
+            [(artist, title) for title in notFound])
+        if self.artists % COMMIT_EVERY == COMMIT_EVERY - 1:
+            self.conn.commit()
+
+    def writeFailed(self, artist):
+        self.conn.execute("INSERT INTO failed VALUES (?)", (artist,))
+
+    def finish(self):
+        for table in ("new_albums", "itunes_albums", "not_found"):
+            self.conn.execute("CREATE INDEX %s_artist ON %s (artist)" % (table, table))
+        self.conn.commit()
+        self.conn.close()
+
+def openExports(formats, base):
+    """Return an Export for each of formats, writing to files named base
+    plus the format's extension (or suffixes, for csv)"""
+    exports = []
+    for format in formats:
+        if format == "jsonl":
+            exports.append(JSONLinesExport(base + ".jsonl"))
+        elif format == "csv":
+            exports.append(CSVExport(base))
+        elif format == "sqlite":
+            exports.append(SQLiteExport(base + ".sqlite"))
+    return exports
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+"Indexed store of the albums found in iTunes on previous runs"
+
+import os, codecs
+
+DEBUG = False
+
+def replaceFile(src, dst):
+    "Rename src to dst, replacing dst if it exists (os.rename won't on Windows)"
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+class HistoryStore:
+    """
+    Albums found in iTunes on previous runs, held as {artist: set(albums)} so
+    checking whether we've seen an album is a dict and a set lookup.  It's
+    backed by the tab separated artist/album file NewAlbumFinder.dat has always
+    used, which is treated as an append-only journal: update() only queues the
+    albums we hadn't seen before, and commit() appends them with a single
+    write.  The file is rewritten (sorted, without duplicates) only when
+    compact() is called, or automatically on load once more than half of its
+    lines are duplicates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.albums = {}
+        self.pending = []
+        self.partialLine = False    # file doesn't end with a newline
+        lines = 0
+        if os.path.exists(path):
+            f = codecs.open(path, 'r', 'utf8')
+            for line in f:
+                self.partialLine = not line.endswith(u'\n')
+                fields = line.rstrip(u'\r\n').split(u'\t')
+                if len(fields) != 2:
+                    continue    # e.g. last line cut short by a crash
+                lines += 1
+                artist, album = fields
+                self.albums.setdefault(artist, set()).add(album)
+            f.close()
+        if lines > 2 * self.count():
+            self.compact()
+
+    def count(self):
+        "Return the number of artist/album pairs in the store"
+        return sum([len(albums) for albums in self.albums.values()])
+
+    def seen(self, artist, album):
+        "Return True if album by artist was found on a previous run"
+        albums = self.albums.get(artist)
+        return albums is not None and album in albums
+
+    def update(self, artist, albums):
+        "Add albums found for artist; new ones are written out by the next commit()"
+        known = self.albums.setdefault(artist, set())
+        for album in albums:
+            if album not in known:
+                known.add(album)
+                self.pending.append((artist, album))
+
+    def commit(self):
+        "Append the albums added since the last commit to the file"
+        if not self.pending:
+            return
+        lines = [artist + u"\t" + album + u"\n" for artist, album in self.pending]
+        if self.partialLine:
+            lines.insert(0, u"\n")     # don't tack our first album onto a partly written line
+            self.partialLine = False
+        f = codecs.open(self.path, 'a', 'utf8')
+        f.write(u''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if DEBUG: print "appended %d albums to %s" % (len(lines), self.path)
+        self.pending = []
+
+    def compact(self):
+        "Rewrite the file sorted by artist and album without duplicates, including pending albums"
+        tmpPath = self.path + ".tmp"
+        f = codecs.open(tmpPath, 'w', 'utf8')
+        for artist in sorted(self.albums.keys()):
+            for album in sorted(self.albums[artist]):
+                f.write(artist + u"\t" + album + u"\n")
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        replaceFile(tmpPath, self.path)
+        self.pending = []
+        self.partialLine = False
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+"Paginated HTML report of the CDs we don't have"
+
+import os, codecs, cgi, urllib, unicodedata
+
+DEBUG = False
+
+PAGE_SIZE = 500     # albums per page
+
+STYLE = """body {font-family: sans-serif}
+table {border-collapse: collapse}
+td, th {border: 1px solid #999; padding: 2px 6px}
+img {width: 100px; height: 100px}
+.nav {margin: 1em 0}
+.nav a {margin-right: 0.5em}"""
+
+def escape(value):
+    "Return value as unicode, escaped for use in HTML text or a quoted attribute"
+    if not isinstance(value, unicode):
+        value = unicode(str(value), 'utf-8', 'replace')
+    return cgi.escape(value, True).replace(u"'", u"&#39;")
+
+def fold(name):
+    "Return name upper-cased with its accents dropped, e.g. EMILE for \u00c9mile"
+    return u''.join([c for c in unicodedata.normalize('NFKD', name)
+        if not unicodedata.combining(c)]).upper()
+
+def indexLetter(name):
+    "Return the letter name is listed under in the index: A-Z, or # for anything else"
+    letter = fold(name[:1])[:1]
+    if 'A' <= letter <= 'Z':
+        return letter
+    return u'#'
+
+def sortKey(name):
+    """Key to sort the artists passed to HTMLReport.addArtist by, so each
+    index letter's artists are together: those under # first, then A-Z
+    with accented letters among the plain ones"""
+    return (indexLetter(name) != u'#', fold(name), name)
+
+class HTMLReport:
+    """
+    Writes the report as it's given artists (in sortKey order) rather
+    than building it all in memory.  The albums go on numbered pages of
+    about pageSize albums each (an artist is never split across pages),
+    written next to path as <name>-1.html, <name>-2.html and so on, and
+    path itself becomes an index page linking to each page by the artists
+    on it and by letter.  Only one page is open at a time, and all that's
+    kept of the finished ones is what the index needs.  Images are loaded
+    lazily, so the browser only fetches the cover art being looked at.
+    """
+
+    def __init__(self, path, title, pageSize=PAGE_SIZE):
+        self.path = path
+        self.title = title
+        self.pageSize = pageSize
+        self.base = os.path.splitext(path)[0]
+        self.pages = []         # (first artist, last artist, albums) for each finished page
+        self.letters = []       # (letter, page number, anchor) where each letter starts
+        self.page = None        # file of the page being written
+        self.firstArtist = self.lastArtist = None   # on that page
+        self.pageAlbums = 0
+        self.artists = self.albums = 0
+
+    def pagePath(self, number):
+        return "%s-%d.html" % (self.base, number)
+
+    def pageLink(self, number, anchor=None):
+        "Return the relative URL of page number (0 for the index page)"
+        if number:
+            link = urllib.quote(os.path.basename(self.pagePath(number)).encode('utf-8'))
+        else:
+            link = urllib.quote(os.path.basename(self.path).encode('utf-8'))
+        if anchor:
+            link += "#" + anchor
+        return link
+
+    def openFile(self, path, heading):
+        f = codecs.open(path, "w", "utf-8")
+        f.write(u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8">
+<style>%s</style>
+<title>%s</title></head><body><h1>%s</h1>\n""" % (STYLE, escape(self.title), escape(heading)))
+        return f
+
+    def startPage(self):
+        number = len(self.pages) + 1
+        self.page = self.openFile(self.pagePath(number), u"%s, page %d" % (self.title, number))
+        # Whether there'll be a next page isn't known yet, so only the
+        #  links at the bottom of the page go forward
+        self.page.write(self.navigation(number, True))
+        self.firstArtist = None
+        self.pageAlbums = 0
+
+    def finishPage(self, last):
+        "Finish the page being written; last is True if there are no more pages after it"
+        number = len(self.pages) + 1
+        self.page.write(self.navigation(number, last))
+        self.page.write(u"</body></html>\n")
+        self.page.close()
+        self.page = None
+        self.pages.append((self.firstArtist, self.lastArtist, self.pageAlbums))
+        if DEBUG: print "wrote report page", number
+
+    def navigation(self, number, last):
+        "Return the links to the index and neighbouring pages for page number"
+        links = [u"<a href='%s'>Index</a>" % escape(self.pageLink(0))]
+        if number > 1:
+            links.append(u"<a href='%s'>&larr; Page %d</a>" % (escape(self.pageLink(number - 1)), number - 1))
+        if not last:
+            links.append(u"<a href='%s'>Page %d &rarr;</a>" % (escape(self.pageLink(number + 1)), number + 1))
+        return u"<div class='nav'>%s</div>\n" % u" ".join(links)
+
+    def addArtist(self, artist, albums):
+        """
+        Add the new albums by artist, a list of
+        [year, title, genre, tracks, image, albumLink] lists.
+        """
+        if self.page and self.pageAlbums >= self.pageSize:
+            self.finishPage(False)
+        if not self.page:
+            self.startPage()
+        number = len(self.pages) + 1
+        anchor = u"a%d" % self.artists
+        letter = indexLetter(artist)
+        if not self.letters or self.letters[-1][0] != letter:
+            self.letters.append((letter, number, anchor))
+        self.page.write(u"<h3 id='%s'>%s</h3><table><tr><th></th><th>Album</th><th>Year</th>"
+            u"<th>Genre</th><th>Tracks</th></tr>\n" % (anchor, escape(artist)))
+        for year, title, genre, tracks, image, albumLink in albums:
+            self.page.write(u"<tr><td><a href='%s' target='_new'><img src='%s' loading='lazy' alt=''></a></td>"
+                u"<td><a href='%s' target='_new'>%s</a></td><td>%s</td><td>%s</td><td>%s</td></tr>\n"
+                % (escape(albumLink), escape(image), escape(albumLink), escape(title),
+                   escape(year or u''), escape(genre), escape(tracks)))
+        self.page.write(u"</table>\n")
+        if self.firstArtist is None:
+            self.firstArtist = artist
+        self.lastArtist = artist
+        self.pageAlbums += len(albums)
+        self.artists += 1
+        self.albums += len(albums)
+
+    def close(self):
+        "Finish the last page and write the index page"
+        if self.page:
+            self.finishPage(True)
+        # Remove pages left over from an earlier, longer report
+        number = len(self.pages) + 1
+        while os.path.exists(self.pagePath(number)):
+            os.remove(self.pagePath(number))
+            number += 1
+        f = self.openFile(self.path, self.title)
+        f.write(u"<p>%d albums by %d artists</p>\n" % (self.albums, self.artists))
+        if self.letters:
+            f.write(u"<div class='nav'>%s</div>\n" % u" ".join([u"<a href='%s'>%s</a>"
+                % (escape(self.pageLink(number, anchor)), escape(letter))
+                for letter, number, anchor in self.letters]))
+        f.write(u"<ol>\n")
+        for number, (first, last, albums) in enumerate(self.pages):
+            f.write(u"<li><a href='%s'>%s &ndash; %s</a> (%d albums)</li>\n"
+                % (escape(self.pageLink(number + 1)), escape(first), escape(last), albums))
+        f.write(u"</ol>\n</body></html>\n")
+        f.close()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+"HTTP client that keeps connections to the iTunes store open between searches"
+
+import httplib, urlparse, threading, socket
+
+DEBUG = False
+
+class HTTPStatusError(IOError):
+    "Raised for HTTP responses with an error status"
+    def __init__(self, code, url):
+        IOError.__init__(self, "HTTP error %d fetching %s" % (code, url))
+        self.code = code
+        self.url = url
+
+class HostPool:
+    "Idle connections to one host, and a semaphore capping the requests in flight to it"
+    def __init__(self, maxRequests):
+        self.slots = threading.BoundedSemaphore(maxRequests)
+        self.lock = threading.Lock()
+        self.idle = []
+
+class KeepAliveClient:
+    """
+    Fetches URLs over persistent HTTP/1.1 connections.  Each connection is
+    reused for later requests to the same host instead of paying for a new
+    TCP connection per artist, and at most maxPerHost requests to any one
+    host are in flight at once.  Safe to use from several threads; each
+    request gets a connection of its own for as long as it runs.
+    """
+
+    def __init__(self, maxPerHost=4, timeout=30):
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.connections = 0    # number of connections opened, reported as http.connections
+
+    def hostPool(self, scheme, netloc):
+        with self.lock:
+            pool = self.hosts.get((scheme, netloc))
+            if pool is None:
+                pool = self.hosts[(scheme, netloc)] = HostPool(self.maxPerHost)
+            return pool
+
+    def connect(self, scheme, netloc):
+        if DEBUG: print "opening connection to", netloc
+        with self.lock:
+            self.connections += 1
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def get(self, url, parse=None):
+        """Return the body of the response to a GET of url; raises HTTPStatusError
+        for error responses.  If parse is given, it's called with the response
+        as a file object to read the body as it arrives, and what it returns
+        is returned instead."""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        pool = self.hostPool(parts.scheme, parts.netloc)
+        pool.slots.acquire()
+        try:
+            with pool.lock:
+                conn = pool.idle and pool.idle.pop() or None
+            for attempt in (1, 2):
+                reused = conn is not None
+                if not reused:
+                    conn = self.connect(parts.scheme, parts.netloc)
+                try:
+                    conn.request("GET", path, headers={"Connection": "keep-alive"})
+                    response = conn.getresponse()
+                    if parse and response.status < 400:
+                        body = parse(response)
+                        response.read()     # the rest, so the connection can be reused
+                    else:
+                        body = response.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    conn = None
+                    # The server may have dropped an idle connection; retry once on a new one
+                    if not reused or attempt == 2:
+                        raise
+                except:
+                    conn.close()    # parse gave up part way through the body
+                    raise
+            if response.will_close:
+                conn.close()
+            else:
+                with pool.lock:
+                    pool.idle.append(conn)
+        finally:
+            pool.slots.release()
+        if response.status >= 400:
+            raise HTTPStatusError(response.status, url)
+        return body
+
+    def close(self):
+        with self.lock:
+            for pool in self.hosts.values():
+                with pool.lock:
+                    for conn in pool.idle:
+                        conn.close()
+                    pool.idle = []
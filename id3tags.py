@@ -2,7 +2,13 @@
 #
 "Class for reading ID3 tags from MP3 files"
 
-import sys, struct, glob, os
+import sys, struct, glob, os, fnmatch, mmap, json
+
+# Use the faster scandir directory listing if it's installed
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 DEBUG = False
 DEBUG2 = False
@@ -20,6 +26,19 @@ FID2name = {'TALB':'album','TCOM':'composer','TDAT':'date','TYER':'year',
     'TENC':'encoder','TPE2':'band','TRCK':'tracknum',
     'TPUB':'publisher','TPE1':'artist','TCON':'content',
     'TIT2':'title','TSSE':'settings','COMM':'comments'}
+# ID3v2.2 used 3 character frame IDs; these are the v2.3 names for the ones we read
+V22toV23 = {'TAL':'TALB','TP1':'TPE1','TP2':'TPE2','TT2':'TIT2','TYE':'TYER',
+    'TRK':'TRCK','TCO':'TCON','TCM':'TCOM','TEN':'TENC','TPB':'TPUB','TSS':'TSSE'}
+# Text encodings, indexed by the first byte of a v2 text frame
+TextEncodings = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+# Frames generateAlbumDataFromMP3s needs; the fast parser stops once it has them
+SCAN_FRAMES = ('TPE1', 'TALB')
+# Frames that fill in all of a TagRecord
+RECORD_FRAMES = ('TPE1', 'TALB', 'TYER', 'TDRC', 'TRCK')
+# How much of a v2 tag to read up front; the rest (usually just embedded
+#  pictures) is only read if we haven't found the frames we want in it
+V2_READ_SIZE = 16 * 1024
+
 # List of genres defined for ID3V1 where they would be stored by their index number
 # (i.e. a byte with the value 2 would indicate "Country").  In V2, the actual strings are stored in TCON, although
 # it's also legal to use a V1 number in parentheses, so either "Country" or "(2)".
@@ -49,37 +68,319 @@ def genre2num(genre_string):
 # Utility function for returning a list of all MP3 files under a given directory path
 def findMP3s(path):
     "Return a list of filepaths of MP3 files under path"
-    mp3list = []
-    # Need to use a unicode string for path in order to get 
+    return list(iterMP3s(path))
+
+def listDir(dirpath, followLinks):
+    "Return lists of (name, path) for the subdirectories and the files in dirpath"
+    dirs = []
+    files = []
+    if scandir:
+        for entry in scandir(dirpath):
+            if entry.is_dir(follow_symlinks=followLinks):
+                dirs.append((entry.name, entry.path))
+            else:
+                files.append((entry.name, entry.path))
+    else:
+        for name in os.listdir(dirpath):
+            subpath = os.path.join(dirpath, name)
+            if os.path.isdir(subpath) and (followLinks or not os.path.islink(subpath)):
+                dirs.append((name, subpath))
+            else:
+                files.append((name, subpath))
+    return dirs, files
+
+def iterMP3s(path, include=("*.mp3",), exclude=(), followLinks=False):
+    """
+    Generator yielding the filepaths of MP3 files under path as the directory
+    tree is walked, so the caller can start reading tags right away.  Each
+    directory's files are yielded together, before those of its subdirectories.
+    File names are matched against the include globs (case-insensitively);
+    files and directories whose name or path relative to path matches one of
+    the exclude globs are skipped.  If followLinks is set, symbolic links to
+    directories are walked too, but no directory is visited twice.
+    """
+    # Need to use a unicode string for path in order to get
     #  unicode for the filepaths which you'll need for accented chars
-    os.path.walk(unicode(path), addMP3s, mp3list)
-    return mp3list
-    
-def addMP3s(mp3list, dirname, files):
-    "Works with os.path.walk to add the full path of all MP3 file in dirpath to mp3list"
-    for file in files:
-        if file.lower()[-4:] == ".mp3":
-            mp3list.append(os.path.join(dirname, file))
+    path = unicode(path)
+    include = [pattern.lower() for pattern in include]
+    def excluded(name, subpath):
+        relpath = os.path.relpath(subpath, path)
+        for pattern in exclude:
+            if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern):
+                return True
+        return False
+    visited = set()
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        if followLinks:
+            st = os.stat(dirpath)
+            if (st.st_dev, st.st_ino) in visited:
+                if DEBUG: print "Skipping directory loop at", dirpath
+                continue
+            visited.add((st.st_dev, st.st_ino))
+        try:
+            dirs, files = listDir(dirpath, followLinks)
+        except OSError:
+            continue    # unreadable directory
+        for name, subpath in files:
+            lname = name.lower()
+            for pattern in include:
+                if fnmatch.fnmatchcase(lname, pattern):
+                    if not excluded(name, subpath):
+                        yield subpath
+                    break
+        # Push in reverse so subdirectories are walked in listing order
+        for name, subpath in reversed(dirs):
+            if not excluded(name, subpath):
+                stack.append(subpath)
+
+def syncsafe(s, offset=0):
+    "Convert the 4 byte ID3 \"syncsafe\" integer at offset in string s into an integer"
+    b0, b1, b2, b3 = struct.unpack_from('BBBB', s, offset)
+    return b3 + (b2 << 7) + (b1 << 14) + (b0 << 21)
+
+def decodeText(data, start, end):
+    "Decode the v2 text frame body occupying data[start:end] to unicode"
+    encoding = ord(data[start])
+    if encoding == 0:
+        # ISO-8859-1, ends at the first NUL
+        nul = data.find('\0', start + 1, end)
+        if nul >= 0: end = nul
+        return unicode(data[start+1:end], 'ISO-8859-1')
+    if encoding > 3:
+        return u''
+    # v2.4 allows several NUL separated strings; we only want the first
+    text = data[start+1:end].decode(TextEncodings[encoding], 'replace')
+    return text.split(u'\x00')[0]
+
+def readV2TextFrames(f, wanted=SCAN_FRAMES):
+    """
+    Fast path for reading the text frames of the ID3v2 tag at the start of
+    open file f.  The tag is read with as few f.read calls as possible and its
+    frames are walked in place with struct.unpack_from; only the wanted frames
+    are decoded, and we stop as soon as all of them have been found.  Returns
+    a dict of {frameID: unicode text} (frame IDs as in v2.3, even for v2.2
+    tags), or None if f doesn't start with a v2 tag.
+    """
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != "ID3":
+        return None
+    major = ord(header[3])
+    flags = ord(header[5])
+    size = syncsafe(header, 6)
+    data = f.read(min(size, V2_READ_SIZE))
+    if flags & 0x80 and major < 4:
+        # Unsynchronised tag: read it all so we can undo the 0xFF 0x00 escaping
+        data = (data + f.read(size - len(data))).replace('\xff\x00', '\xff')
+        size = len(data)
+    if major == 2:
+        hdrSize = 6
+    else:
+        hdrSize = 10
+    pos = 0
+    if flags & 0x40 and major > 2:
+        # Skip extended header
+        if len(data) < 4: data += f.read(size - len(data))
+        if major == 3:
+            pos = 4 + struct.unpack_from('>L', data, 0)[0]
+        else:
+            pos = syncsafe(data, 0)
+    frames = {}
+    remaining = len(wanted)
+    while pos + hdrSize <= size:
+        if pos + hdrSize > len(data):
+            data += f.read(size - len(data))
+            if pos + hdrSize > len(data): break     # truncated tag
+        if data[pos] == '\0':
+            break   # reached the padding after the last frame
+        if major == 2:
+            frameID = V22toV23.get(data[pos:pos+3], data[pos:pos+3])
+            b0, b1, b2 = struct.unpack_from('BBB', data, pos + 3)
+            frameSize = (b0 << 16) + (b1 << 8) + b2
+        else:
+            frameID = data[pos:pos+4]
+            if major == 4:
+                frameSize = syncsafe(data, pos + 4)
+            else:
+                frameSize = struct.unpack_from('>L', data, pos + 4)[0]
+        if frameSize == 0: break    # no more frames
+        start = pos + hdrSize
+        pos = start + frameSize
+        if frameID in wanted and frameID not in frames:
+            if pos > len(data):
+                data += f.read(size - len(data))
+                if start >= len(data): break    # truncated tag
+            frames[frameID] = decodeText(data, start, min(pos, len(data)))
+            remaining -= 1
+            if remaining == 0:
+                break
+    return frames
+
+class TagRecord(object):
+    """Compact tag info for library scans: just artist, album, year and
+    track number (None for anything the tag didn't have).  Use ID3V2tag
+    instead if you need all the frames, e.g. to rewrite the tag."""
+    __slots__ = ('artist', 'album', 'year', 'track')
+
+    def __init__(self, artist=None, album=None, year=None, track=None):
+        self.artist = artist
+        self.album = album
+        self.year = year
+        self.track = track
 
+    @classmethod
+    def fromFrames(cls, frames):
+        "Build a record from a readV2TextFrames dict"
+        year = frames.get('TYER') or frames.get('TDRC')   # TDRC replaced TYER in v2.4
+        track = frames.get('TRCK', '').split('/')[0]
+        return cls(frames.get('TPE1'), frames.get('TALB'),
+            year and year[:4] or None, track.isdigit() and int(track) or None)
+
+    def __str__(self):
+        return "Artist: %s, Album: %s, Year: %s, Trk: %s" % \
+            (self.artist, self.album, self.year, self.track)
+
+def readV1Record(f):
+    "Return a TagRecord from the ID3v1 tag at the end of open file f, or None if it has none"
+    f.seek(0, SEEK_END)
+    if f.tell() < 128:
+        return None
+    f.seek(-128, SEEK_END)
+    tagData = f.read(128)
+    if tagData[0:3] != 'TAG':
+        return None
+    year = unicode(tagData[93:97].rstrip(' \t\0'), 'latin-1')
+    track = None
+    if tagData[125] == '\0' and tagData[126] != '\0':
+        track = ord(tagData[126])
+    return TagRecord(unicode(tagData[33:63].rstrip(' \t\0'), 'latin-1'),
+        unicode(tagData[63:93].rstrip(' \t\0'), 'latin-1'), year or None, track)
+
+def readTagRecord(mp3path, wanted=RECORD_FRAMES, useMmap=False, counts=None):
+    """
+    Return a TagRecord for mp3path, or None if it has neither a v2 nor a v1
+    tag.  The file is opened once: the v2 tag at the head is read first since
+    it should be more accurate, and only if it's missing or lacks the artist
+    or album is the 128 byte v1 tag at the tail read and used instead.  Only
+    the wanted v2 frames are read, so the scan can pass SCAN_FRAMES to get
+    just the artist and album.  With useMmap, the file is mapped into memory
+    instead of read.  If a counts dict is given, the kind of tag the record
+    came from ("id3.v2", "id3.v1", "id3.v2+v1" for a v1 tag used in place
+    of an incomplete v2 one, or "id3.none" if there's no tag or only an
+    incomplete v2 one) and the bytes read
+    ("id3.bytesRead") are counted in it.
+    """
+    f = open(mp3path, "rb")
+    try:
+        src = f
+        if useMmap:
+            try:
+                src = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                pass    # e.g. empty file, just read it normally
+        frames = readV2TextFrames(src, wanted)
+        bytesRead = src.tell()      # the v2 tag is read from the start of the file
+        record = None
+        source = "id3.v2"
+        if frames is not None:
+            record = TagRecord.fromFrames(frames)
+        if record is None or record.artist is None or record.album is None:
+            v1record = readV1Record(src)
+            bytesRead += 128    # the v1 tag, or where it would be
+            if record is None:
+                record = v1record
+                source = "id3.v1"
+            elif v1record:
+                # Use the v1 tag as a whole rather than mixing fields from
+                #  two tags that may not describe the same release
+                record = v1record
+                source = "id3.v2+v1"
+            else:
+                source = "id3.none"     # the scan can't use the incomplete v2 tag
+            if record is None:
+                source = "id3.none"
+        if counts is not None:
+            counts[source] = counts.get(source, 0) + 1
+            counts["id3.bytesRead"] = counts.get("id3.bytesRead", 0) + bytesRead
+        if src is not f:
+            src.close()
+    finally:
+        f.close()
+    return record
+
+class AlbumDB:
+    """
+    The albums we have, as {artist: [album, ...]} with each artist's albums
+    kept unique.  Artists and their albums stay in the order they were
+    added.  Most artists only have a few albums, which add() checks for a
+    duplicate by scanning the list; once an artist has more than SET_AFTER,
+    their albums are also kept in a set so that check stays O(1) however
+    many there are.  The sets are only needed while albums are being added,
+    so compact() drops them once the database is built, and trims each
+    list to its size.  Save and reload it with dump() and load().
+    """
+    SET_AFTER = 16      # albums an artist has before we keep a set of them too
 
-class ListDict:
-    """Like normal dictionary, but automatically add key if not present
-    and values are kept in a list and only added if unique"""
     def __init__(self):
-        self.dict = {}
-    
+        self.dict = {}          # {artist: [albums]}
+        self.artists = []       # in the order they were added
+        self.albumSets = {}     # {artist: set(albums)} for artists with many albums
+
     def __getitem__(self, key):
         return self.dict[key]
-                
+
+    def __contains__(self, key):
+        return key in self.dict
+
+    def __len__(self):
+        return len(self.artists)
+
     def add(self, key, value):
-        if key in self.dict:
-            if value not in self.dict[key]:
-                self.dict[key].append(value)
-        else:
+        albums = self.dict.get(key)
+        if albums is None:
             self.dict[key] = [value]
-            
+            self.artists.append(key)
+            return
+        albumSet = self.albumSets.get(key)
+        if albumSet is None:
+            if len(albums) <= self.SET_AFTER:
+                if value in albums:
+                    return
+                albums.append(value)
+                return
+            albumSet = self.albumSets[key] = set(albums)    # e.g. after compact()
+        if value not in albumSet:
+            albumSet.add(value)
+            albums.append(value)
+
     def keys(self):
-        return self.dict.keys()
+        return list(self.artists)
+
+    def compact(self):
+        """Free the memory only needed while adding albums (they can still be
+        added): the sets, and the spare room append() leaves in each list"""
+        self.albumSets = {}
+        for artist in self.artists:
+            self.dict[artist] = self.dict[artist][:]
+
+    def dump(self, f):
+        "Write the albums to open file f as JSON"
+        json.dump([[artist, self.dict[artist]] for artist in self.artists], f,
+            separators=(',', ':'))
+
+    @classmethod
+    def load(cls, f):
+        "Return an AlbumDB of the albums saved by dump() to open file f"
+        db = cls()
+        for artist, albums in json.load(f):
+            for album in albums:
+                db.add(artist, album)
+        db.compact()
+        return db
+
+# The old name of AlbumDB, which was a dict of plain lists
+ListDict = AlbumDB
 
 class ID3V1tag:
     """Read/write ID3 version 1 tags in mp3 files."""
@@ -163,10 +464,10 @@ class ID3V2tag:
     size = 0
     bytesIn = 0
     album = artist = title = 'N/A'
-    rawData = {}
     
     def __init__(self, mp3path):
         self.file = mp3path
+        self.rawData = {}   # per tag, so frames from one file don't leak into the next
         self.f = open(mp3path, "rb")
         header = self.f.read(10)     # read the 10 byte header
         if header[:3] != "ID3":
@@ -260,12 +561,8 @@ class ID3V2tag:
         # First byte indicates text encoding
         if data[0] == '\0':
             # ISO-8859-1 encoding
-            lastChar = len(data)
-            for i in range(1, len(data)):
-                if DEBUG: print i, data[i]
-                if data[i] == '\0':
-                    lastChar = i
-                    break
+            lastChar = data.find('\0', 1)
+            if lastChar < 0: lastChar = len(data)
             text = data[1:lastChar]
             text = unicode(text, 'ISO-8859-1')
         elif data[0] == '\01':
@@ -307,7 +604,7 @@ class ID3V2tag:
         return struct.pack('BBBB', b0, b1, b2, b3)
     
 if __name__ == "__main__":
-    albumDB = ListDict()
+    albumDB = AlbumDB()
     dirname = sys.argv[1]
     files = glob.glob(dirname + os.path.sep + "*.mp3")
     nfiles = len(files)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#
+"""
+Local stand-in for the iTunes store search service, for benchmarking and
+testing searches without the network.  It answers artist searches with
+synthetic iTunes-format results, after a configurable delay and with a
+configurable share of throttled (429) or failed (503) responses.
+
+Run it with e.g.
+    python mockstore.py --port 8000 --latency 0.2 --error-rate 0.05
+and point NewAlbumFinder at it with --catalog-url http://localhost:8000/search
+"""
+
+import BaseHTTPServer, SocketServer, urlparse, json, random, threading, time, socket
+import optparse
+
+DEBUG = False
+
+def syntheticResults(term, albums):
+    """Return a list of iTunes-format results for artist search term.  The same
+    term always gets the same results: albums albums by the artist (a few of
+    them singles or EPs), plus a couple by other artists with similar names."""
+    rand = random.Random(term)
+    artist = u' '.join([word.capitalize() for word in term.split()])
+    results = []
+    for n in range(albums):
+        year = rand.randint(1960, 2016)
+        if rand.random() < 0.1:
+            title = u"%s Song %d - Single" % (artist, n)
+            tracks = rand.randint(1, 3)
+        else:
+            title = u"%s Album %d" % (artist, n)
+            tracks = rand.randint(4, 20)
+        results.append(albumResult(artist, title, tracks, year, rand))
+    for n in range(2):
+        results.append(albumResult(artist + u" Tribute Band", u"Tribute %d" % n, 10,
+            rand.randint(1960, 2016), rand))
+    return results
+
+def albumResult(artist, title, tracks, year, rand):
+    "Return one iTunes-format album result"
+    collectionId = rand.randint(100000000, 999999999)
+    return {"wrapperType": "collection", "collectionType": "Album",
+        "artistName": artist, "collectionName": title,
+        "collectionCensoredName": title, "trackCount": tracks,
+        "releaseDate": "%04d-01-01T08:00:00Z" % year,
+        "copyright": u"\u2117 %04d Mock Records" % year,
+        "primaryGenreName": rand.choice(["Rock", "Pop", "Jazz", "Alternative", "Country"]),
+        "artworkUrl100": "http://is1.mzstatic.com/image/thumb/%d/100x100bb.jpg" % collectionId,
+        "collectionViewUrl": "https://itunes.apple.com/us/album/id%d" % collectionId,
+        "collectionId": collectionId, "country": "USA", "currency": "USD",
+        "collectionPrice": 9.99}
+
+class MockStoreHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # so clients can keep connections alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Don't hold back the body until the headers are acknowledged; on a
+        # kept alive connection that costs a delayed ACK (~40ms) per response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(random.expovariate(1.0 / server.latency))
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        if random.random() < server.errorRate:
+            self.reply(random.choice((429, 503)), "Slow down")
+            return
+        term = query.get("term", [""])[0].decode("utf-8")
+        results = syntheticResults(term, server.albums)
+        self.reply(200, json.dumps({"resultCount": len(results), "results": results}),
+            "text/javascript; charset=utf-8")
+
+    def reply(self, status, body, contentType="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if DEBUG: BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class MockStoreServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded mock store.  latency is the mean response delay in seconds,
+    errorRate the share of requests that fail and albums the number of albums
+    returned per artist."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128    # the default 5 drops connections when many workers connect at once
+
+    def __init__(self, port=0, latency=0.0, errorRate=0.0, albums=10):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), MockStoreHandler)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.albums = albums
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def url(self):
+        "Return the URL to pass as --catalog-url"
+        return "http://127.0.0.1:%d/search" % self.server_address[1]
+
+def startMockStore(port=0, latency=0.0, errorRate=0.0, albums=10):
+    "Start a MockStoreServer on a background thread and return it; call shutdown() to stop it"
+    server = MockStoreServer(port, latency, errorRate, albums)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--port", type="int", dest="port", default=8000,
+        help="port to listen on [default: %default]")
+    parser.add_option("-l", "--latency", type="float", dest="latency", default=0.0,
+        help="mean response delay in seconds [default: %default]")
+    parser.add_option("-e", "--error-rate", type="float", dest="errorRate", default=0.0,
+        help="fraction of requests answered with 429 or 503 [default: %default]")
+    parser.add_option("-a", "--albums", type="int", dest="albums", default=10,
+        help="albums returned per artist [default: %default]")
+    (options, args) = parser.parse_args()
+    server = MockStoreServer(options.port, options.latency, options.errorRate, options.albums)
+    print "Mock store listening at", server.url()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+"Counters, timers and histograms describing how a scan and search went"
+
+import time, json, threading, bisect
+
+DEBUG = False
+
+# Upper bounds of the buckets latencies in milliseconds are counted in
+LATENCY_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+# and those counts (e.g. of albums per artist) are counted in
+COUNT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Histogram:
+    "Distribution of a value, counted in buckets with the given upper bounds"
+
+    def __init__(self, bounds=LATENCY_BOUNDS_MS):
+        self.bounds = list(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)     # the last one is for larger values
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def percentile(self, p):
+        "Return the upper bound of the bucket holding the p'th percentile value"
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n and i < len(self.bounds):
+                return self.bounds[i]
+        return self.max
+
+    def asDict(self):
+        mean = None
+        if self.count:
+            mean = self.total / self.count
+        return {"count": self.count, "total": self.total, "min": self.min, "max": self.max,
+            "mean": mean,
+            "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+            "buckets": [[bound, n] for bound, n in zip(self.bounds + ["inf"], self.buckets)]}
+
+class Timer:
+    "Context manager adding the time spent in its block to a Stats timer"
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.addTime(self.name, time.time() - self.start)
+
+class Stats:
+    """
+    Named counters, timers and histograms, plus values derived from them
+    (rates and ratios), filled in as a scan or search runs.  Names are
+    dotted by phase, e.g. "scan.files" or "http.latencyMs".  Safe to update
+    from several threads.  asDict() returns everything in a form that can
+    be saved as JSON, so runs can be compared.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}        # {name: [seconds, times timed]}
+        self.histograms = {}
+        self.values = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def addCounts(self, counts):
+        "Add a dict of {name: count}, e.g. as collected in a scan worker process"
+        with self.lock:
+            for name, n in counts.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def get(self, name):
+        "Return the value of a counter, 0 if it was never counted"
+        return self.counters.get(name, 0)
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += 1
+
+    def timer(self, name):
+        "Return a context manager timing its block as name"
+        return Timer(self, name)
+
+    def seconds(self, name):
+        "Return the total time of a timer, 0 if it never ran"
+        return self.timers.get(name, [0.0, 0])[0]
+
+    def observe(self, name, value, bounds=LATENCY_BOUNDS_MS):
+        "Add value to the histogram name"
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.add(value)
+
+    def setRate(self, name, counter, timer):
+        "Set value name to counter's count per second of timer's time"
+        seconds = self.seconds(timer)
+        self.values[name] = None
+        if seconds:
+            self.values[name] = self.get(counter) / seconds
+
+    def setRatio(self, name, counter, counters):
+        "Set value name to the share of the total of counters that counter is"
+        total = sum([self.get(c) for c in counters])
+        self.values[name] = None
+        if total:
+            self.values[name] = float(self.get(counter)) / total
+
+    def asDict(self):
+        with self.lock:
+            return {"counters": dict(self.counters),
+                "timers": dict([(name, {"seconds": t[0], "count": t[1]})
+                    for name, t in self.timers.items()]),
+                "histograms": dict([(name, h.asDict()) for name, h in self.histograms.items()]),
+                "values": dict(self.values)}
+
+    def dump(self, path):
+        "Save the stats to path as JSON"
+        f = open(path, "w")
+        json.dump(self.asDict(), f, indent=2, sort_keys=True)
+        f.close()
+        if DEBUG: print "saved stats to", path
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+"Opt-in profiling of the scan and search phases"
+
+import cProfile, pstats, os, threading
+
+# The statprof sampling profiler has much less overhead than cProfile, but
+#  isn't in the standard library
+try:
+    import statprof
+except ImportError:
+    statprof = None
+
+DEBUG = False
+
+class PhaseProfiler:
+    """
+    Profiles each phase of a run (e.g. "scan", "search") passed to run(),
+    writing the results to outputDir as <prefix>-<phase>.pstats, which can
+    be loaded with the pstats module or a viewer like snakeviz, and
+    <prefix>-<phase>-top.txt, the top functions by cumulative and by own
+    time.  cProfile only sees the thread it runs in, so worker threads
+    started with threadTarget() are profiled separately and merged in.
+    Work done in other processes (e.g. a parallel scan) isn't seen.
+    With sampling, the statprof sampling profiler is used instead if it's
+    installed; it only samples the main thread and only writes the
+    top-functions summary.
+    """
+
+    def __init__(self, outputDir, prefix, top=30, sampling=False):
+        self.outputDir = outputDir
+        self.prefix = prefix
+        self.top = top
+        self.sampling = sampling and statprof is not None
+        if sampling and not self.sampling:
+            print "statprof isn't installed, profiling with cProfile instead"
+        self.lock = threading.Lock()
+        self.threadProfiles = []
+
+    def path(self, phase, suffix):
+        return os.path.join(self.outputDir, "%s-%s%s" % (self.prefix, phase, suffix))
+
+    def run(self, phase, fun, *args, **kwargs):
+        "Return fun(*args, **kwargs), profiling it as phase"
+        if self.sampling:
+            return self.runSampled(phase, fun, *args, **kwargs)
+        self.threadProfiles = []
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fun, *args, **kwargs)
+        finally:
+            # Even if the phase was aborted, what it did so far is worth seeing
+            self.save(phase, profile)
+
+    def runSampled(self, phase, fun, *args, **kwargs):
+        statprof.reset()
+        statprof.start()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            statprof.stop()
+            f = open(self.path(phase, "-top.txt"), "w")
+            statprof.display(f)
+            f.close()
+
+    def threadTarget(self, target):
+        "Return a thread target that runs target under a profile merged into the current phase"
+        if self.sampling:
+            return target
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(target, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.threadProfiles.append(profile)
+        return profiled
+
+    def save(self, phase, profile):
+        stats = pstats.Stats(profile)
+        with self.lock:
+            for threadProfile in self.threadProfiles:
+                stats.add(threadProfile)
+            self.threadProfiles = []
+        stats.dump_stats(self.path(phase, ".pstats"))
+        f = open(self.path(phase, "-top.txt"), "w")
+        stats.stream = f
+        f.write("Top %d functions of the %s by cumulative time\n" % (self.top, phase))
+        stats.sort_stats("cumulative").print_stats(self.top)
+        f.write("Top %d functions of the %s by own time\n" % (self.top, phase))
+        stats.sort_stats("tottime").print_stats(self.top)
+        f.close()
+        if DEBUG: print "saved %s profile to %s" % (phase, self.path(phase, ".pstats"))
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+"Adaptive rate limiting and retry backoff for iTunes store requests"
+
+import time, random, threading, collections
+
+DEBUG = False
+
+# HTTP status codes the store uses to tell us to slow down.  Not 503: when
+# the store is down, slowing to a crawl only makes the run take forever
+THROTTLE_CODES = (403, 429)
+
+def backoffDelay(attempt, base=1.0, cap=60.0):
+    "Seconds to wait before retry number attempt: exponential backoff with full jitter"
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class TokenBucket:
+    """
+    Token bucket allowing rate requests per second on average, in bursts of
+    up to burst requests.  The rate adapts to the server: it's halved
+    (down to minRate) each time the server throttles us, and creeps back
+    up towards the starting rate with each successful request.
+    Safe to share between threads.
+    """
+
+    def __init__(self, rate, burst=None, minRate=0.1):
+        self.maxRate = self.rate = float(rate)
+        self.minRate = min(minRate, self.maxRate)
+        self.burst = burst or max(1.0, self.maxRate)
+        self.increase = self.maxRate / 50     # rate regained per successful request
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, cancel=None):
+        """Wait until a request may be made; returns False instead if the
+        cancel event is set while we're waiting"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if cancel is None:
+                time.sleep(wait)
+            elif cancel.wait(wait):
+                return False
+
+    def throttled(self):
+        "The server told us to slow down"
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)   # and stop any burst in progress
+        if DEBUG: print "throttled, rate now %.2f/s" % self.rate
+
+    def succeeded(self):
+        "A request went through"
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.increase)
+
+class CircuitBreaker:
+    """
+    Gives up on the server once nearly every request is failing (e.g. it's
+    down, or we're offline), so a run fails fast instead of retrying every
+    artist with backoff.  It opens when at least threshold of the last
+    window requests failed; while it's open, allow() only lets one request
+    through every cooldown seconds to see if the server is back, and a
+    success closes it again.  Safe to share between threads.
+    """
+
+    def __init__(self, window=10, threshold=0.9, cooldown=30.0):
+        self.window = window
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.outcomes = collections.deque(maxlen=window)    # True for each success
+        self.failures = 0   # in outcomes
+        self.probeAt = 0    # when the next request may go through while open
+        self.lock = threading.Lock()
+
+    def isOpen(self):
+        with self.lock:
+            return self.opened()
+
+    def opened(self):
+        return len(self.outcomes) == self.window and self.failures >= self.threshold * self.window
+
+    def allow(self):
+        "Return True if a request may be made"
+        with self.lock:
+            if not self.opened():
+                return True
+            now = time.time()
+            if now < self.probeAt:
+                return False
+            self.probeAt = now + self.cooldown
+            return True
+
+    def record(self, succeeded):
+        "Record the outcome of a request"
+        with self.lock:
+            if succeeded and self.opened():
+                self.outcomes.clear()   # the server's back
+                self.failures = 0
+                self.probeAt = 0
+                if DEBUG: print "server is answering again"
+            if len(self.outcomes) == self.window and not self.outcomes[0]:
+                self.failures -= 1      # about to drop off the end
+            self.outcomes.append(succeeded)
+            if not succeeded:
+                self.failures += 1
+                if self.opened() and not self.probeAt:
+                    if DEBUG: print "nearly every request is failing, giving up on the server"
+                    self.probeAt = time.time() + self.cooldown
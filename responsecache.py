@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+"Persistent on-disk cache of iTunes search responses"
+
+import sqlite3, time, threading
+
+DEBUG = False
+
+# Bumped whenever what's cached for a URL changes, so old entries are dropped
+# rather than misread.  2: the album dicts parsed from a response, not the response
+FORMAT = 2
+
+class ResponseCache:
+    """Cache of search responses keyed by URL, kept in a sqlite file.
+    Each entry expires ttl seconds after it was fetched.  Once the cached
+    responses take up more than maxBytes, the least recently used entries
+    are evicted."""
+
+    def __init__(self, path, ttl=7*24*3600, maxBytes=50*1024*1024):
+        self.path = path
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        # Lookups come from the search worker threads, so share one
+        # connection and serialize access to it
+        self.lock = threading.Lock()
+        # When entries were last used, saved with the next write rather
+        #  than committing on every hit
+        self.used = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != FORMAT:
+            self.conn.execute("DROP TABLE IF EXISTS responses")
+            self.conn.execute("PRAGMA user_version = %d" % FORMAT)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY, body TEXT, size INTEGER,
+            expires REAL, lastUsed REAL)""")
+        self.conn.commit()
+
+    def get(self, url, allowStale=False):
+        "Return the cached response for url, or None if missing or expired"
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT body, expires FROM responses WHERE url=?",
+                (url,)).fetchone()
+            if row is None or (row[1] < now and not allowStale):
+                return None
+            self.used[url] = now
+        if DEBUG: print "cache hit:", url
+        return row[0]
+
+    def put(self, url, body, ttl=None):
+        "Save body as the response for url, good for ttl seconds"
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        size = len(body)
+        if isinstance(body, unicode):
+            size = len(body.encode('utf-8'))    # maxBytes is in bytes, not characters
+        with self.lock:
+            self.saveUsed()
+            self.used.pop(url, None)
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (url, body, size, now + ttl, now))
+            self.conn.commit()
+
+    def saveUsed(self):
+        "Write the pending lastUsed times, to be committed with the caller's change"
+        if self.used:
+            self.conn.executemany("UPDATE responses SET lastUsed=? WHERE url=?",
+                [(used, url) for url, used in self.used.items()])
+            self.used = {}
+
+    def evict(self):
+        "Drop least recently used entries until the cache fits in maxBytes"
+        with self.lock:
+            self.saveUsed()
+            self.conn.commit()
+            total = self.conn.execute("SELECT SUM(size) FROM responses").fetchone()[0] or 0
+            if total <= self.maxBytes:
+                return 0
+            dropped = []
+            for url, size in self.conn.execute("SELECT url, size FROM responses ORDER BY lastUsed"):
+                if total <= self.maxBytes:
+                    break
+                dropped.append((url,))
+                total -= size
+            self.conn.executemany("DELETE FROM responses WHERE url=?", dropped)
+            self.conn.commit()
+        if DEBUG: print "evicted %d cached responses" % len(dropped)
+        return len(dropped)
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.conn.close()
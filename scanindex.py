@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+"Persistent index of the artist/album read from each MP3 file"
+
+import sqlite3, threading
+
+DEBUG = False
+
+# Bumped whenever how the artist and album are read from a file changes, so
+# files indexed the old way are read again.  2: a v1 tag is used whole in
+# place of an incomplete v2 tag, rather than filling in its missing fields
+FORMAT = 2
+
+class ScanIndex:
+    """Remembers the artist and album found in each MP3 file, keyed by
+    the file's path, modification time and size, so a rescan only has to
+    read the tags of new or changed files.  Files with no usable tag are
+    recorded too (with artist and album of None) so they aren't re-read
+    every time."""
+
+    COMMIT_EVERY = 1000     # number of stores between commits
+
+    def __init__(self, path):
+        self.path = path
+        # A parallel scan looks files up from the multiprocessing task feeder
+        # thread while results are stored from the main thread
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != FORMAT:
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute("PRAGMA user_version = %d" % FORMAT)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+            artist TEXT, album TEXT)""")
+        self.conn.commit()
+        self.pending = 0
+
+    def get(self, path):
+        """Return (mtime, size, artist, album) as indexed for path, or None
+        if the file isn't in the index.  It's up to the caller to check
+        mtime and size against the file before trusting artist and album."""
+        with self.lock:
+            return self.conn.execute("SELECT mtime, size, artist, album FROM files WHERE path=?",
+                (path,)).fetchone()
+
+    def store(self, path, mtime, size, artist, album):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (path, mtime, size, artist, album))
+            self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.commit()
+
+    def prune(self, seenPaths):
+        "Drop files that weren't seen in the last full scan (i.e. have been deleted)"
+        with self.lock:
+            gone = [(path,) for (path,) in self.conn.execute("SELECT path FROM files")
+                    if path not in seenPaths]
+            self.conn.executemany("DELETE FROM files WHERE path=?", gone)
+        self.commit()
+        if DEBUG: print "dropped %d deleted files from scan index" % len(gone)
+        return len(gone)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM files")
+        self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.conn.close()